@@ -0,0 +1,171 @@
+#########################################################################
+#                                                                       #
+#    Author Yannick Paul Klose                                          #
+#    Year   2019                                                        #
+#                                                                       #
+#########################################################################
+
+import math
+
+import numpy as np
+import torch
+import torchvision
+
+from openpifpaf import transforms
+
+
+def pil_to_uint8_tensor(image):
+    # (3, H, W) uint8 tensor, a quarter of the bytes of a float32 image
+    return torch.from_numpy(np.array(image, dtype=np.uint8)).permute(2, 0, 1)
+
+
+# worker part of transforms.image_transform_train, the rest runs per batch
+# in BatchImageTransform (jpeg compression has to stay on PIL images)
+image_transform_uint8 = torchvision.transforms.Compose([  # pylint: disable=invalid-name
+    torchvision.transforms.RandomApply([
+        torchvision.transforms.Lambda(transforms.jpeg_compression_augmentation),
+    ], p=0.1),
+    torchvision.transforms.Lambda(pil_to_uint8_tensor),
+])
+
+
+def grayscale(images):
+    # (B, 1, H, W) luma with the ITU-R 601 weights of PIL
+    weights = images.new_tensor([0.299, 0.587, 0.114]).view(1, 3, 1, 1)
+    return (images * weights).sum(dim=1, keepdim=True)
+
+
+def rotate_hue(images, angles):
+    # hue rotation in YIQ space, a linear approximation of the HSV hue shift
+    # of ColorJitter that works on the whole batch at once
+    rgb_to_yiq = images.new_tensor([[0.299, 0.587, 0.114],
+                                    [0.596, -0.274, -0.322],
+                                    [0.211, -0.523, 0.312]])
+    yiq_to_rgb = torch.inverse(rgb_to_yiq)
+
+    cos, sin = torch.cos(angles), torch.sin(angles)
+    rotation = torch.zeros(len(angles), 3, 3, device=images.device, dtype=images.dtype)
+    rotation[:, 0, 0] = 1.0
+    rotation[:, 1, 1] = cos
+    rotation[:, 1, 2] = -sin
+    rotation[:, 2, 1] = sin
+    rotation[:, 2, 2] = cos
+    matrices = yiq_to_rgb.unsqueeze(0) @ rotation @ rgb_to_yiq.unsqueeze(0)
+
+    return torch.einsum('bij,bjhw->bihw', matrices, images)
+
+
+def valid_area_mask(valid_areas, height, width, device):
+    # (B, 1, H, W) mask that is zero where mask_valid_image zeros the image
+    valid_areas = torch.tensor([[int(x), int(y),
+                                 int(math.ceil(x + w)), int(math.ceil(y + h))]
+                                for x, y, w, h in valid_areas], device=device)
+    ys = torch.arange(height, device=device).view(1, height, 1)
+    xs = torch.arange(width, device=device).view(1, 1, width)
+    mask = ((ys >= valid_areas[:, 1].view(-1, 1, 1)) &
+            (ys < valid_areas[:, 3].view(-1, 1, 1)) &
+            (xs >= valid_areas[:, 0].view(-1, 1, 1)) &
+            (xs < valid_areas[:, 2].view(-1, 1, 1)))
+    return mask.unsqueeze(1)
+
+
+class BatchImageTransform(object):
+    """transforms.image_transform_train and mask_valid_image for uint8 batches.
+
+    Images are moved to `device` as uint8 and converted there. Brightness,
+    contrast, saturation and hue are jittered with an independent factor
+    per image (in this fixed order, ColorJitter shuffles it), followed by
+    random grayscale, normalization and masking of the invalid area.
+    """
+
+    def __init__(self, device=None, *,
+                 brightness=0.1, contrast=0.1, saturation=0.1, hue=0.1,
+                 grayscale_probability=0.01):
+        self.device = device
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.grayscale_probability = grayscale_probability
+
+    @staticmethod
+    def uniform(n, low, high, generator):
+        # random numbers are drawn on the CPU, so a seeded generator gives
+        # the same augmentation on every device
+        return torch.empty(n).uniform_(low, high, generator=generator)
+
+    def factors(self, images, amount, generator):
+        return self.uniform(images.shape[0], 1.0 - amount, 1.0 + amount, generator).view(
+            -1, 1, 1, 1).to(images.device)
+
+    def jitter(self, images, generator):
+        if self.brightness:
+            images = (images * self.factors(images, self.brightness, generator)).clamp(0.0, 1.0)
+        if self.contrast:
+            mean = grayscale(images).mean(dim=(2, 3), keepdim=True)
+            factor = self.factors(images, self.contrast, generator)
+            images = (factor * images + (1.0 - factor) * mean).clamp(0.0, 1.0)
+        if self.saturation:
+            factor = self.factors(images, self.saturation, generator)
+            images = (factor * images + (1.0 - factor) * grayscale(images)).clamp(0.0, 1.0)
+        if self.hue:
+            angles = self.uniform(images.shape[0], -self.hue, self.hue, generator) * 2.0 * math.pi
+            images = rotate_hue(images, angles.to(images.device)).clamp(0.0, 1.0)
+        return images
+
+    def __call__(self, images, meta, generator=None):
+        if self.device is not None:
+            images = images.to(self.device, non_blocking=True)
+        images = images.float().div_(255.0)
+
+        images = self.jitter(images, generator)
+
+        to_gray = torch.rand(images.shape[0], generator=generator) < self.grayscale_probability
+        to_gray = to_gray.view(-1, 1, 1, 1).to(images.device)
+        images = torch.where(to_gray, grayscale(images).expand_as(images), images)
+
+        mean = images.new_tensor(transforms.normalize.mean).view(1, 3, 1, 1)
+        std = images.new_tensor(transforms.normalize.std).view(1, 3, 1, 1)
+        images = (images - mean) / std
+
+        mask = valid_area_mask([m['valid_area'] for m in meta],
+                               images.shape[2], images.shape[3], images.device)
+        return images * mask.float()
+
+
+class BatchTransformLoader(object):
+    """Iterate a DataLoader of uint8 images and transform every batch.
+
+    The random augmentations come from a generator of this loader. With a
+    `seed` it is reseeded at the start of every pass, so seeded loaders
+    (see PR_datasets_detection.seeded_loader) give the same images in every
+    run; otherwise it is seeded from torch.initial_seed(). Pass the
+    `generator` of another loader to continue its random sequence (see
+    PR_datasets_detection.rescale_loader).
+    """
+
+    def __init__(self, loader, transform, seed=None, generator=None):
+        self.loader = loader
+        self.transform = transform
+        self.seed = seed
+        if generator is None:
+            generator = torch.Generator()
+            generator.manual_seed(torch.initial_seed() if seed is None else seed)
+        self.generator = generator
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    def __iter__(self):
+        if self.seed is not None:
+            self.generator.manual_seed(self.seed)
+        for images, targets, meta in self.loader:
+            yield self.transform(images, meta, self.generator), targets, meta
+
+    def __len__(self):
+        return len(self.loader)
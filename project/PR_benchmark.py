@@ -0,0 +1,154 @@
+#########################################################################
+#                                                                       #
+#    Author Yannick Paul Klose                                          #
+#    Year   2019                                                        #
+#                                                                       #
+#########################################################################
+
+"""Compare checkpoints: accuracy on the frozen validation set vs CPU latency."""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+import PR_datasets_detection as datasets
+import PR_metrics
+import PR_train
+import PR_trainer
+from openpifpaf.network import nets
+
+
+def load_model(checkpoint):
+    if checkpoint.endswith('.weights'):
+        model, _ = PR_trainer.load_weights(checkpoint)
+        return model
+    model, _ = nets.factory(checkpoint=checkpoint)
+    return model
+
+
+def n_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+def cpu_latency(model, square_edge, n_runs=20, n_warmup=3):
+    # median and 90th percentile of single image forward passes in ms
+    model = model.cpu().eval()
+    image = torch.randn(1, 3, square_edge, square_edge)
+
+    times = []
+    with torch.no_grad():
+        for i in range(n_warmup + n_runs):
+            start = time.perf_counter()
+            model(image)
+            if i >= n_warmup:
+                times.append((time.perf_counter() - start) * 1000.0)
+
+    return float(np.percentile(times, 50)), float(np.percentile(times, 90))
+
+
+def evaluate(model, val_loader, device, *,
+             pixel_thresholds=PR_metrics.PIXEL_THRESHOLDS,
+             detection_threshold=PR_metrics.DETECTION_THRESHOLD):
+    # checkpoints are loaded for inference, so confidences are sigmoids
+    model = model.to(device).eval()
+    stride = model.io_scales()[0]
+    logits = not model.head_nets[0].apply_class_sigmoid
+
+    statistics = None
+    with torch.no_grad():
+        for images, _, meta in val_loader:
+            outputs = model(images.to(device, non_blocking=True))
+            statistics = PR_metrics.accumulate(statistics, PR_metrics.center_statistics(
+                outputs[0], PR_metrics.centers_from_meta(meta), stride,
+                pixel_thresholds=pixel_thresholds,
+                detection_threshold=detection_threshold,
+                logits=logits,
+            ))
+
+    return PR_metrics.summarize(statistics, pixel_thresholds)
+
+
+def compare(models, val_loader, args):
+    # rows of name, parameters, accuracy and latency; speedups relative
+    # to the first model
+    rows = []
+    for name, model in models:
+        row = {'name': name, 'parameters': n_parameters(model)}
+        row.update(evaluate(model, val_loader, args.device,
+                            pixel_thresholds=args.val_pixel_thresholds,
+                            detection_threshold=args.val_detection_threshold))
+        row['latency_ms'], row['latency_p90_ms'] = cpu_latency(
+            model, args.square_edge, n_runs=args.latency_runs)
+        rows.append(row)
+
+    for row in rows:
+        row['speedup'] = round(rows[0]['latency_ms'] / row['latency_ms'], 2)
+    return rows
+
+
+def print_report(rows):
+    columns = [c for c in rows[0].keys() if c != 'name']
+    print('{:40s} '.format('model') + ' '.join('{:>16s}'.format(c) for c in columns))
+    for row in rows:
+        print('{:40s} '.format(row['name'][-40:]) + ' '.join(
+            '{:>16.4g}'.format(row[c]) for c in columns))
+
+
+def cli(parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser(
+            description=__doc__,
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        )
+    datasets.train_cli(parser)
+    parser.add_argument('--square-edge', default=401, type=int,
+                        help='square edge of input images')
+    parser.add_argument('--crop-fraction', default=0.5, type=float,
+                        help='crop fraction versus rescale')
+    parser.add_argument('--val-pixel-thresholds', default=list(PR_metrics.PIXEL_THRESHOLDS),
+                        type=float, nargs='+',
+                        help='pixel thresholds for the validation detection rates')
+    parser.add_argument('--val-detection-threshold', default=PR_metrics.DETECTION_THRESHOLD,
+                        type=float, help='confidence threshold for a validation detection')
+    parser.add_argument('--latency-runs', default=20, type=int,
+                        help='number of timed CPU forward passes per model')
+    parser.add_argument('--threads', default=None, type=int,
+                        help='number of CPU threads for the latency measurement')
+    parser.add_argument('--disable-cuda', action='store_true',
+                        help='disable CUDA for the accuracy evaluation')
+    return parser
+
+
+def configure(args):
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    args.device = torch.device('cpu')
+    args.pin_memory = False
+    if not args.disable_cuda and torch.cuda.is_available():
+        args.device = torch.device('cuda')
+        args.pin_memory = True
+
+
+def val_loader_from_args(args):
+    # same composites as the frozen validation set of PR_train
+    return datasets.val_factory(args, PR_train.preprocess_factory(args, args.square_edge),
+                                cache_file=args.val_cache)
+
+
+def main():
+    parser = cli()
+    parser.add_argument('checkpoints', nargs='+',
+                        help='checkpoints to compare, the first is the reference')
+    args = parser.parse_args()
+    configure(args)
+
+    val_loader = val_loader_from_args(args)
+    models = [(checkpoint, load_model(checkpoint)) for checkpoint in args.checkpoints]
+    print_report(compare(models, val_loader, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#########################################################################
+#                                                                       #
+#    Author Yannick Paul Klose                                          #
+#    Year   2019                                                        #
+#                                                                       #
+#########################################################################
+
+"""Latency and recall of coarse-to-fine versus single-pass inference."""
+
+import time
+
+import numpy as np
+import torch
+
+import PR_benchmark
+import PR_datasets_detection as datasets
+import PR_inference
+import PR_metrics
+from openpifpaf import decoder, transforms
+
+
+def detection_statistics(keypoint_sets, center, pixel_thresholds, detection_threshold):
+    # most confident keypoint of every confident detection against the
+    # ground truth center (v = 0 for images without a pattern)
+    detections = [kps[np.argmax(kps[:, 2]), :2] for kps in keypoint_sets
+                  if np.max(kps[:, 2]) > detection_threshold]
+    positive = center[2] > 0
+    errors = [np.linalg.norm(xy - np.asarray(center[:2])) for xy in detections]
+    return {
+        'n_positive': int(positive),
+        'n_negative': int(not positive),
+        'n_false_positive': int(not positive and len(detections) > 0),
+        'hits': [int(positive and any(e <= t for e in errors)) for t in pixel_thresholds],
+    }
+
+
+def timed(device, f, *args):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    result = f(*args)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return result, (time.perf_counter() - start) * 1000.0
+
+
+def benchmark(name, infer, loader, args):
+    # infer(image_batch) returns (keypoint_sets, scores) of a single image
+    latencies = []
+    total = None
+    for images, _, meta in loader:
+        for image, image_meta in zip(images, meta):
+            image = image.unsqueeze(0).to(args.device)
+            (keypoint_sets, _), latency = timed(args.device, infer, image)
+            latencies.append(latency)
+
+            total = PR_metrics.accumulate(total, detection_statistics(
+                keypoint_sets, image_meta['center'],
+                args.val_pixel_thresholds, args.val_detection_threshold))
+
+    row = {
+        'name': name,
+        'latency_ms': float(np.percentile(latencies, 50)),
+        'latency_p90_ms': float(np.percentile(latencies, 90)),
+        'fp_rate': round(total['n_false_positive'] / max(1, total['n_negative']), 4),
+    }
+    for t, hits in zip(args.val_pixel_thresholds, total['hits']):
+        row['recall@{:g}'.format(t)] = round(hits / max(1, total['n_positive']), 4)
+    return row
+
+
+def cli():
+    parser = PR_benchmark.cli()
+    decoder.cli(parser, force_complete_pose=False, instance_threshold=0.05)
+    parser.add_argument('checkpoint',
+                        help='checkpoint to benchmark')
+    parser.add_argument('--full-edge', default=640, type=int,
+                        help='long edge of the full resolution composites')
+    parser.add_argument('--benchmark-images', default=200, type=int,
+                        help='number of composites')
+    parser.add_argument('--coarse-scale', default=0.5, type=float,
+                        help='scale of the frame for the coarse pass')
+    parser.add_argument('--coarse-top-k', default=3, type=int,
+                        help='maximum number of candidates from the coarse pass')
+    parser.add_argument('--coarse-peak-threshold', default=0.1, type=float,
+                        help='minimum confidence of a coarse candidate')
+    parser.add_argument('--crop-size', default=193, type=int,
+                        help='edge of the full resolution crops around candidates')
+    args = parser.parse_args()
+    PR_benchmark.configure(args)
+    return args
+
+
+def main():
+    args = cli()
+
+    model = PR_benchmark.load_model(args.checkpoint).to(args.device).eval()
+    processor = decoder.factory_from_args(args, model, device=args.device)
+    coarse_to_fine = PR_inference.CoarseToFine(processor,
+                                               coarse_scale=args.coarse_scale,
+                                               top_k=args.coarse_top_k,
+                                               crop_size=args.crop_size,
+                                               peak_threshold=args.coarse_peak_threshold)
+
+    # frozen composites (fixed seeds) at full resolution instead of the
+    # training edge, cached next to (not in) the training --val-cache
+    preprocess = transforms.SquareRescale(args.full_edge, black_bars=True, horizontal_swap=None)
+    cache_file = None
+    if args.val_cache:
+        cache_file = '{}.edge{}-n{}'.format(args.val_cache, args.full_edge, args.benchmark_images)
+    loader = datasets.val_factory(args, preprocess, num_val_images=args.benchmark_images,
+                                  cache_file=cache_file)
+
+    def single_pass(image):
+        return processor.keypoint_sets(processor.fields(image)[0])
+
+    def two_stage(image):
+        return coarse_to_fine.keypoint_sets(coarse_to_fine.fields(image)[0])
+
+    rows = [
+        benchmark('single-pass', single_pass, loader, args),
+        benchmark('coarse-to-fine', two_stage, loader, args),
+    ]
+    for row in rows:
+        row['speedup'] = round(rows[0]['latency_ms'] / row['latency_ms'], 2)
+    PR_benchmark.print_report(rows)
+    print('coarse to fine', coarse_to_fine.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,9 @@
 #########################################################################
 
 
+import contextlib
 import copy
+import json
 import logging
 import os
 import torch.utils.data
@@ -17,8 +19,9 @@ from PIL import Image
 
 from openpifpaf import transforms
 from openpifpaf import utils
-from openpifpaf.datasets import collate_images_targets_meta
+from openpifpaf.datasets import collate_images_anns_meta, collate_images_targets_meta
 
+import PR_batch_transforms
 import PR_pillow_testing
 from skimage import measure                        
 from shapely.geometry import Polygon, MultiPolygon 
@@ -36,7 +39,7 @@ IMAGE_DIR_VAL = 'data-mscoco/images/train2017/'
 
 class CocoKeypoints(torch.utils.data.Dataset):
     
-    def __init__(self, root, annFile, image_transform=None, target_transforms=None, preprocess=None, horzontalflip=None):
+    def __init__(self, root, annFile, image_transform=None, target_transforms=None, preprocess=None, horzontalflip=None, repeats=1, max_pastes=1, mask_valid=True):
         from pycocotools.coco import COCO
         self.root = root
         self.coco = COCO(annFile)
@@ -53,10 +56,51 @@ class CocoKeypoints(torch.utils.data.Dataset):
         self.image_transform = image_transform or transforms.image_transform
         self.target_transforms = target_transforms
 
+        # composites per decoded background and patterns per composite
+        self.repeats = repeats
+        self.max_pastes = max_pastes
+        # False when the valid area is masked per batch (uint8 transport)
+        self.mask_valid = mask_valid
+
         self.log = logging.getLogger(self.__class__.__name__)
             
 
     def __getitem__(self, index):
+        if self.repeats == 1:
+            return self.transform(*self.render(index))
+
+        # decode the background once for several independent composites
+        background = self.load_background(index)
+        return [self.transform(*self.render(index, background)) for _ in range(self.repeats)]
+
+    def transform(self, image, anns, meta):
+        # transform image
+        original_size = image.size
+        image = self.image_transform(image)
+        assert image.size(2) == original_size[0]
+        assert image.size(1) == original_size[1]
+
+        # mask valid
+        if self.mask_valid:
+            valid_area = meta['valid_area']
+            utils.mask_valid_image(image, valid_area)
+
+        # if there are not target transforms, done here
+        self.log.debug(meta)
+        if self.target_transforms is None:
+            return image, anns, meta
+
+        # transform targets
+        targets = [t(anns, original_size) for t in self.target_transforms]
+        return image, targets, meta
+
+    def load_background(self, index):
+        image_info = self.coco.loadImgs(self.ids[index])[0]
+        return PR_pillow_testing.load_background(IMAGE_DIR_TRAIN + str(image_info['file_name']), False)
+
+    def render(self, index, background=None):
+        # paste the pattern on the background and preprocess the composite
+        # (everything before the image transform)
         image_id = self.ids[index]
         ann_ids = self.coco.getAnnIds(imgIds=image_id)
         anns = self.coco.loadAnns(ann_ids)
@@ -76,7 +120,7 @@ class CocoKeypoints(torch.utils.data.Dataset):
             
         # just for after training on special dataset 
         after_training = False
-        anns, overlay_image = self.modify_keypoints(anns, image_info['file_name'], paste, after_training)
+        anns, overlay_image = self.modify_keypoints(anns, image_info['file_name'], paste, after_training, background)
        
         image = overlay_image.convert('RGB')
 
@@ -95,34 +139,15 @@ class CocoKeypoints(torch.utils.data.Dataset):
         image, anns, preprocess_meta = self.preprocess(image, anns)
 
         meta.update(preprocess_meta)
-
-        # transform image
-        original_size = image.size
-        image = self.image_transform(image)
-        assert image.size(2) == original_size[0]
-        assert image.size(1) == original_size[1]
-
-        # mask valid
-        valid_area = meta['valid_area']
-        utils.mask_valid_image(image, valid_area)
-
-        # if there are not target transforms, done here
-        self.log.debug(meta)
-        if self.target_transforms is None:
-            return image, anns, meta
-
-        # transform targets
-        targets = [t(anns, original_size) for t in self.target_transforms]
-        return image, targets, meta
+        return image, anns, meta
     
     def __len__(self):
         return len(self.ids)
     
 
-    def modify_keypoints(self, anns, filename, paste, after_training):
-        # in the end we just want to have one keypoint
+    def modify_keypoints(self, anns, filename, paste, after_training, background=None):
+        # in the end we just want to have one keypoint per pasted object
         # this keypoints is the center of our chosen tracking object
-        keypoint_array = [0]*(3)
 
        
         # image ID is the same all annotations of one image
@@ -131,22 +156,15 @@ class CocoKeypoints(torch.utils.data.Dataset):
         background_path = IMAGE_DIR_TRAIN + str(filename)
         object_path = "tracked_pattern/model2.png"
         
-        if after_training:
-            # background path will be overwritten!
-            image, center_x, center_y, x_pos, y_pos, length, height = PR_pillow_testing.overlay(background_path, object_path, paste, True)
-        else: 
-            # take coco dataset for training!
-            image, center_x, center_y, x_pos, y_pos, length, height = PR_pillow_testing.overlay(background_path, object_path, paste, False)
-        
-        # set keypoint array
-        keypoint_array[0] = center_x
-        keypoint_array[1] = center_y
-        if (paste):
-            # we always set the keypoint to visible 
-            keypoint_array[2] = 2       
+        if background is None:
+            # after training: background path will be overwritten!
+            # otherwise take coco dataset for training!
+            image = PR_pillow_testing.load_background(background_path, after_training)
         else:
-            # if paste is not true, no image is inserted
-            keypoint_array[2] = 0       
+            # decoded background shared by several composites
+            image = background.copy()
+        n_pastes = random.randint(1, self.max_pastes) if paste else 1
+        pastes = PR_pillow_testing.paste_objects(image, object_path, paste, n_pastes)
             
         # extract important information out of json file
         image_id = ann['image_id']
@@ -154,10 +172,22 @@ class CocoKeypoints(torch.utils.data.Dataset):
         is_crowd = 0                    
         annotations = []
      
-        # create annotations
-        annotation_object = self.create_annotation(x_pos, y_pos, length, height, image_id, annotation_id, is_crowd)
-        annotation_object['keypoints'] = keypoint_array
-        annotations.append(annotation_object)
+        # create one annotation per pasted object
+        for center_x, center_y, x_pos, y_pos, length, height in pastes:
+            # set keypoint array
+            keypoint_array = [0]*(3)
+            keypoint_array[0] = center_x
+            keypoint_array[1] = center_y
+            if (paste):
+                # we always set the keypoint to visible 
+                keypoint_array[2] = 2       
+            else:
+                # if paste is not true, no image is inserted
+                keypoint_array[2] = 0       
+
+            annotation_object = self.create_annotation(x_pos, y_pos, length, height, image_id, annotation_id, is_crowd)
+            annotation_object['keypoints'] = keypoint_array
+            annotations.append(annotation_object)
         
         return annotations, image
     
@@ -196,7 +226,261 @@ class CocoKeypoints(torch.utils.data.Dataset):
                     if has_keypoint_annotation(image_id)]
 
         print('... done.')
-    
+
+
+@contextlib.contextmanager
+def fixed_seed(seed):
+    # seed python, numpy and the torch CPU generator (used by the square
+    # transforms) and restore the previous random states afterwards.
+    # torch.manual_seed would also reseed the CUDA generators of training
+    states = random.getstate(), np.random.get_state(), torch.get_rng_state()
+    random.seed(seed)
+    np.random.seed(seed % 2**32)
+    torch.default_generator.manual_seed(seed)
+    try:
+        yield
+    finally:
+        random.setstate(states[0])
+        np.random.set_state(states[1])
+        torch.set_rng_state(states[2])
+
+
+class FrozenCocoKeypoints(torch.utils.data.Dataset):
+    """Validation composites rendered once from fixed seeds.
+
+    Composite i is rendered with seed `seed + i`, so the same indices and
+    seed give the same images in every epoch and in every run. The rendered
+    images are kept as uint8 either in memory or in a memory-mapped
+    `cache_file` (reused by later runs when indices, seed, preprocessing and
+    image shape match) and are only normalized on access.
+    """
+
+    def __init__(self, dataset, indices, seed=0, cache_file=None):
+        self.target_transforms = dataset.target_transforms
+        self.indices = [int(i) for i in indices]
+        self.seed = seed
+        self.preprocess_key = describe(dataset.preprocess)
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+        # the shape of the first composite is part of the cache key
+        first = self.render(dataset, 0)
+        shape = (len(self.indices),) + first[0].shape
+        if cache_file is not None and self.load(cache_file, shape):
+            print('Loaded frozen validation set: {}'.format(cache_file))
+            return
+
+        if cache_file is None:
+            self.images = np.empty(shape, dtype=np.uint8)
+        else:
+            # a header of an interrupted rebuild must not match the new images
+            if os.path.exists(cache_file + '.json'):
+                os.remove(cache_file + '.json')
+            self.images = np.memmap(cache_file + '.tmp', dtype=np.uint8, mode='w+', shape=shape)
+
+        self.anns = []
+        self.metas = []
+        for i in range(len(self.indices)):
+            image, anns, meta = first if i == 0 else self.render(dataset, i)
+            self.images[i] = image
+            meta['center'] = self.center(anns, image.shape)
+            self.anns.append(anns)
+            self.metas.append(meta)
+
+        if cache_file is not None:
+            self.images.flush()
+            os.replace(cache_file + '.tmp', cache_file)
+            self.save(cache_file)
+        print('Rendered frozen validation set: {} images'.format(len(self.indices)))
+
+    def render(self, dataset, i):
+        with fixed_seed(self.seed + i):
+            image, anns, meta = dataset.render(self.indices[i])
+        return np.asarray(image, dtype=np.uint8), anns, meta
+
+    @staticmethod
+    def center(anns, shape):
+        # ground truth center in input image coordinates,
+        # [0, 0, 0] for no-paste images and centers that were cropped away
+        keypoint = np.asarray(anns[0]['keypoints'], dtype=np.float32).reshape(-1, 3)[0]
+        if keypoint[2] <= 0 or \
+           not 0 <= keypoint[0] < shape[1] or not 0 <= keypoint[1] < shape[0]:
+            return [0.0, 0.0, 0.0]
+        return [float(keypoint[0]), float(keypoint[1]), float(keypoint[2])]
+
+    def save(self, cache_file):
+        with open(cache_file + '.json.tmp', 'w') as f:
+            json.dump({
+                'seed': self.seed,
+                'indices': self.indices,
+                'preprocess': self.preprocess_key,
+                'shape': list(self.images.shape),
+                'anns': jsonify(self.anns),
+                'metas': jsonify(self.metas),
+            }, f)
+        os.replace(cache_file + '.json.tmp', cache_file + '.json')
+
+    def load(self, cache_file, shape):
+        if not os.path.exists(cache_file) or not os.path.exists(cache_file + '.json'):
+            return False
+        with open(cache_file + '.json') as f:
+            header = json.load(f)
+        if header['seed'] != self.seed or header['indices'] != self.indices or \
+           header.get('preprocess') != self.preprocess_key or tuple(header['shape']) != shape:
+            self.log.info('frozen validation cache %s does not match, re-rendering', cache_file)
+            return False
+
+        self.images = np.memmap(cache_file, dtype=np.uint8, mode='r', shape=shape)
+        self.anns = header['anns']
+        for anns in self.anns:
+            for ann in anns:
+                ann['keypoints'] = np.asarray(ann['keypoints'], dtype=np.float32).reshape(-1, 3)
+                ann['bbox'] = np.asarray(ann['bbox'], dtype=np.float32)
+        self.metas = header['metas']
+        return True
+
+    def __getitem__(self, index):
+        image = Image.fromarray(np.asarray(self.images[index]))
+        meta = copy.deepcopy(self.metas[index])
+
+        original_size = image.size
+        image = transforms.image_transform(image)
+        utils.mask_valid_image(image, meta['valid_area'])
+
+        anns = copy.deepcopy(self.anns[index])
+        if self.target_transforms is None:
+            return image, anns, meta
+
+        targets = [t(anns, original_size) for t in self.target_transforms]
+        return image, targets, meta
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class SeededSubset(torch.utils.data.Dataset):
+    """Subset where sample i is always rendered with seed `seed + i`.
+
+    Unlike FrozenCocoKeypoints nothing is stored, so this is meant for
+    deterministic single passes over a dataset.
+    """
+
+    def __init__(self, dataset, indices, seed=0):
+        self.dataset = dataset
+        self.indices = [int(i) for i in indices]
+        self.seed = seed
+
+    def __getitem__(self, index):
+        with fixed_seed(self.seed + index):
+            return self.dataset[self.indices[index]]
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class HardExampleSampler(torch.utils.data.Sampler):
+    """Oversample backgrounds with a high recent training loss.
+
+    The loss of every background in the pool is tracked as an exponential
+    moving average of the losses reported by the Trainer (see
+    PR_trainer.Trainer sample_loss_observer). Each epoch draws
+    `num_samples` indices from a mix of the uniform distribution and a
+    distribution proportional to loss**power; `hard_fraction` sets the
+    weight of the latter. Backgrounds that were not seen yet get the
+    highest tracked loss so that they are visited early.
+
+    The sampler runs in the main process and losses are reported there,
+    so it works with any number of loader workers.
+    """
+
+    def __init__(self, indices, num_samples, *,
+                 hard_fraction=0.5, power=1.0, decay=0.7):
+        self.indices = np.unique(indices)
+        self.num_samples = num_samples
+        self.hard_fraction = hard_fraction
+        self.power = power
+        self.decay = decay
+
+        self.position = {int(index): i for i, index in enumerate(self.indices)}
+        self.losses = np.full(len(self.indices), np.nan)
+
+    def update(self, dataset_indices, losses):
+        for index, loss in zip(dataset_indices, losses):
+            i = self.position.get(int(index))
+            if i is None:
+                continue
+            if np.isnan(self.losses[i]):
+                self.losses[i] = loss
+            else:
+                self.losses[i] = self.decay * self.losses[i] + (1.0 - self.decay) * loss
+
+    def probabilities(self):
+        uniform = np.full(len(self.indices), 1.0 / len(self.indices))
+        seen = ~np.isnan(self.losses)
+        if not np.any(seen):
+            return uniform
+
+        losses = np.where(seen, self.losses, np.nanmax(self.losses))
+        hard = np.clip(losses, 0.0, None) ** self.power
+        if hard.sum() <= 0.0:
+            return uniform
+        hard /= hard.sum()
+        return (1.0 - self.hard_fraction) * uniform + self.hard_fraction * hard
+
+    def __iter__(self):
+        choice = np.random.choice(len(self.indices), self.num_samples, p=self.probabilities())
+        return iter(self.indices[choice].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+def collate_repeated_images_targets_meta(batch):
+    # every item holds several composites of the same background
+    return collate_images_targets_meta([sample for samples in batch for sample in samples])
+
+
+def describe(obj):
+    # json description of a (preprocess) object from its attributes
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if isinstance(obj, (list, tuple)):
+        return [describe(o) for o in obj]
+    if callable(obj) and hasattr(obj, '__name__'):
+        return obj.__name__
+    if hasattr(obj, '__dict__'):
+        description = {'type': obj.__class__.__name__}
+        description.update((k, describe(v)) for k, v in sorted(vars(obj).items())
+                           if not k.startswith('_') and k != 'log')
+        return description
+    return obj.__class__.__name__
+
+
+def jsonify(data):
+    # convert numpy values in annotations and meta data to plain python
+    if isinstance(data, dict):
+        return {k: jsonify(v) for k, v in data.items()}
+    if isinstance(data, (list, tuple)):
+        return [jsonify(v) for v in data]
+    if isinstance(data, np.ndarray):
+        return data.tolist()
+    if isinstance(data, np.generic):
+        return data.item()
+    return data
+
+
+
+def train_configure(args):
+    if args.background_repeats < 1 or args.batch_size % args.background_repeats != 0:
+        raise Exception('--batch-size {} must be a multiple of --background-repeats {}'.format(
+            args.batch_size, args.background_repeats))
+
+
+def composites_per_item(dataset):
+    # composites per item of (a subset of) CocoKeypoints
+    while not hasattr(dataset, 'repeats') and hasattr(dataset, 'dataset'):
+        dataset = dataset.dataset
+    return getattr(dataset, 'repeats', 1)
 
 
 def train_cli(parser):
@@ -213,6 +497,28 @@ def train_cli(parser):
                        help='number of workers for data loading')
     group.add_argument('--batch-size', default=8, type=int,
                        help='batch size')
+    group.add_argument('--background-repeats', default=1, type=int,
+                       help=('independently augmented composites per decoded background, '
+                             'the batch size stays the number of composites'))
+    group.add_argument('--max-pastes', default=1, type=int,
+                       help='maximum number of non-overlapping patterns per composite')
+    group.add_argument('--uint8-transport', default=False, action='store_true',
+                       help=('workers return uint8 images, normalization, color jitter '
+                             'and masking run per batch in the main process'))
+    group.add_argument('--hard-fraction', default=0.0, type=float,
+                       help='fraction of the training samples drawn proportional '
+                            'to the recent loss of their background (0 is uniform)')
+    group.add_argument('--hard-power', default=1.0, type=float,
+                       help='exponent applied to the losses for hard example sampling')
+    group.add_argument('--hard-decay', default=0.7, type=float,
+                       help='decay of the moving average of background losses')
+    group.add_argument('--resample-val', default=False, action='store_true',
+                       help='re-render random validation composites every epoch '
+                            'instead of using the frozen validation set')
+    group.add_argument('--val-seed', default=0, type=int,
+                       help='seed for rendering the frozen validation set')
+    group.add_argument('--val-cache', default=None,
+                       help='memory-mapped cache file for the frozen validation set')
 
 
 def train_factory(args, preprocess, target_transforms):
@@ -221,9 +527,12 @@ def train_factory(args, preprocess, target_transforms):
         root=args.train_image_dir,
         annFile=args.train_annotations,
         preprocess=preprocess,
-        image_transform=transforms.image_transform_train,
+        image_transform=(PR_batch_transforms.image_transform_uint8 if args.uint8_transport
+                         else transforms.image_transform_train),
         target_transforms=target_transforms,
-        
+        repeats=args.background_repeats,
+        max_pastes=args.max_pastes,
+        mask_valid=not args.uint8_transport,
     )
     
     np.random.seed(100)
@@ -240,8 +549,24 @@ def train_factory(args, preprocess, target_transforms):
         num_val_images = 1000
         num_pretrain_images = 1000
         
-
-    train_loader = torch.utils.data.DataLoader(torch.utils.data.Subset(train_data, np.random.choice(len(train_data),num_train_images)), batch_size=args.batch_size, shuffle=not args.debug, pin_memory=args.pin_memory, num_workers=args.loader_workers, drop_last=True, collate_fn=collate_images_targets_meta)
+    # a batch of args.batch_size composites and an epoch of num_train_images
+    # composites from fewer decoded backgrounds (see train_configure)
+    if args.background_repeats > 1:
+        train_batch_size = args.batch_size // args.background_repeats
+        train_collate = collate_repeated_images_targets_meta
+    else:
+        train_batch_size = args.batch_size
+        train_collate = collate_images_targets_meta
+    num_train_backgrounds = num_train_images // args.background_repeats
+    num_pretrain_backgrounds = num_pretrain_images // args.background_repeats
+
+    train_indices = np.random.choice(len(train_data),num_train_backgrounds)
+    if args.hard_fraction > 0.0:
+        # loss-aware sampling over the same backgrounds
+        sampler = HardExampleSampler(train_indices, num_train_backgrounds, hard_fraction=args.hard_fraction, power=args.hard_power, decay=args.hard_decay)
+        train_loader = torch.utils.data.DataLoader(train_data, sampler=sampler, batch_size=train_batch_size, pin_memory=args.pin_memory, num_workers=args.loader_workers, drop_last=True, collate_fn=train_collate)
+    else:
+        train_loader = torch.utils.data.DataLoader(torch.utils.data.Subset(train_data, train_indices), batch_size=train_batch_size, shuffle=not args.debug, pin_memory=args.pin_memory, num_workers=args.loader_workers, drop_last=True, collate_fn=train_collate)
     
     val_data = CocoKeypoints(
         root=args.val_image_dir,
@@ -253,7 +578,12 @@ def train_factory(args, preprocess, target_transforms):
         
     )
     
-    val_loader = torch.utils.data.DataLoader(torch.utils.data.Subset(val_data, np.random.choice(len(val_data),num_val_images)), batch_size=args.batch_size, shuffle=not args.debug, pin_memory=args.pin_memory, num_workers=args.loader_workers, drop_last=True, collate_fn=collate_images_targets_meta)
+    val_indices = np.random.choice(len(val_data),num_val_images)
+    if args.resample_val:
+        val_loader = torch.utils.data.DataLoader(torch.utils.data.Subset(val_data, val_indices), batch_size=args.batch_size, shuffle=not args.debug, pin_memory=args.pin_memory, num_workers=args.loader_workers, drop_last=True, collate_fn=collate_images_targets_meta)
+    else:
+        # fixed composites, comparable between epochs and runs
+        val_loader = frozen_val_loader(args, val_data, num_val_images, cache_file=args.val_cache)
     
 
     pre_train_data = CocoKeypoints(
@@ -266,7 +596,61 @@ def train_factory(args, preprocess, target_transforms):
         
     )
     
-    pre_train_loader = torch.utils.data.DataLoader(torch.utils.data.Subset(train_data, np.random.choice(len(train_data),num_pretrain_images)), batch_size=args.batch_size, shuffle=not args.debug, pin_memory=args.pin_memory, num_workers=args.loader_workers, drop_last=True, collate_fn=collate_images_targets_meta)
+    pre_train_loader = torch.utils.data.DataLoader(torch.utils.data.Subset(train_data, np.random.choice(len(train_data),num_pretrain_backgrounds)), batch_size=train_batch_size, shuffle=not args.debug, pin_memory=args.pin_memory, num_workers=args.loader_workers, drop_last=True, collate_fn=train_collate)
+
+    if args.uint8_transport:
+        # normalization, color jitter and masking once per batch
+        batch_transform = PR_batch_transforms.BatchImageTransform(args.device)
+        train_loader = PR_batch_transforms.BatchTransformLoader(train_loader, batch_transform)
+        pre_train_loader = PR_batch_transforms.BatchTransformLoader(pre_train_loader, batch_transform)
     
 
     return train_loader, val_loader, pre_train_loader
+
+
+def frozen_val_loader(args, val_data, num_val_images, collate_fn=collate_images_targets_meta, cache_file=None):
+    # images and seeds only depend on --val-seed, so the same set can be
+    # rebuilt outside of training (see val_factory)
+    val_indices = np.random.RandomState(args.val_seed).choice(len(val_data), num_val_images)
+    frozen_val_data = FrozenCocoKeypoints(val_data, val_indices, seed=args.val_seed, cache_file=cache_file)
+    return torch.utils.data.DataLoader(frozen_val_data, batch_size=args.batch_size, shuffle=False, pin_memory=args.pin_memory, num_workers=args.loader_workers, drop_last=False, collate_fn=collate_fn)
+
+
+def val_factory(args, preprocess, target_transforms=None, num_val_images=1000, cache_file=None):
+    # the frozen validation set of train_factory on its own, pass
+    # args.val_cache as cache_file only with the training preprocessing
+    val_data = CocoKeypoints(
+        root=args.val_image_dir,
+        annFile=args.val_annotations,
+        preprocess=preprocess,
+        target_transforms=target_transforms,
+    )
+    collate_fn = collate_images_targets_meta if target_transforms is not None else collate_images_anns_meta
+    return frozen_val_loader(args, val_data, num_val_images, collate_fn=collate_fn, cache_file=cache_file)
+
+
+def seeded_loader(loader, seed):
+    # a deterministic, ordered pass over the samples of a Subset loader
+    if isinstance(loader, PR_batch_transforms.BatchTransformLoader):
+        return PR_batch_transforms.BatchTransformLoader(seeded_loader(loader.loader, seed), loader.transform, seed=seed)
+
+    data = SeededSubset(loader.dataset.dataset, loader.dataset.indices, seed=seed)
+    return torch.utils.data.DataLoader(data, batch_size=loader.batch_size, shuffle=False, pin_memory=loader.pin_memory, num_workers=loader.num_workers, drop_last=False, collate_fn=loader.collate_fn)
+
+
+def rescale_loader(loader, preprocess, target_transforms, batch_size):
+    # same data and sampler with new preprocessing, targets and batch size
+    if isinstance(loader, PR_batch_transforms.BatchTransformLoader):
+        return PR_batch_transforms.BatchTransformLoader(
+            rescale_loader(loader.loader, preprocess, target_transforms, batch_size), loader.transform,
+            seed=loader.seed, generator=loader.generator)
+
+    data = loader.dataset
+    if isinstance(data, torch.utils.data.Subset):
+        data = data.dataset
+    data.preprocess = preprocess
+    data.target_transforms = target_transforms
+    # batch_size counts composites
+    batch_size = max(1, batch_size // getattr(data, 'repeats', 1))
+
+    return torch.utils.data.DataLoader(loader.dataset, sampler=loader.sampler, batch_size=batch_size, pin_memory=loader.pin_memory, num_workers=loader.num_workers, drop_last=loader.drop_last, collate_fn=loader.collate_fn)
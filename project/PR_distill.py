@@ -0,0 +1,279 @@
+#########################################################################
+#                                                                       #
+#    Author Yannick Paul Klose                                          #
+#    Year   2019                                                        #
+#                                                                       #
+#########################################################################
+
+"""Distill a trained pifpaf checkpoint into a small CPU student network."""
+
+import argparse
+import datetime
+import logging
+import socket
+
+import torch
+import torchvision
+
+import PR_benchmark
+import PR_datasets_detection as datasets
+import PR_train
+from PR_trainer import Trainer, epoch_file
+from openpifpaf import encoder, logs, optimize
+from openpifpaf.network import basenetworks, heads, nets
+from openpifpaf import __version__ as VERSION
+
+DEFAULT_LAMBDAS = {
+    'pif': [30.0, 2.0, 2.0],
+    'paf': [50.0, 3.0, 3.0],
+}
+
+STUDENT_BASENETS = {
+    'resnet18': torchvision.models.resnet18,
+    'resnet34': torchvision.models.resnet34,
+}
+
+
+def student_factory(args):
+    # small resnets are not part of nets.factory_from_scratch, build them
+    # with the same blocks (and the same name options) here
+    for head in heads.Head.__subclasses__():
+        head.apply_args(args)
+
+    base_name = next((name for name in STUDENT_BASENETS if args.basenet.startswith(name)), None)
+    if base_name is None:
+        net_cpu, _ = nets.factory_from_args(args)
+        return net_cpu
+    if 'twostage' in args.basenet:
+        raise Exception('two-stage students are not supported: {}'.format(args.basenet))
+
+    # input block variants as in nets.factory_from_scratch
+    conv_stride = 2
+    if 'is4' in args.basenet:
+        conv_stride = 4
+    if 'is1' in args.basenet:
+        conv_stride = 1
+    pool_stride = 4 if 'pool0s4' in args.basenet else 2
+
+    resnet_factory = basenetworks.ResnetBlocks(STUDENT_BASENETS[base_name](args.pretrained))
+    blocks = [
+        resnet_factory.input_block('pool0' in args.basenet, conv_stride, pool_stride),
+        resnet_factory.block2(),
+        resnet_factory.block3(),
+        resnet_factory.block4(),
+    ]
+    if 'block5' in args.basenet:
+        blocks.append(resnet_factory.block5())
+
+    # ResnetBlocks.out_channels() assumes bottleneck blocks
+    out_features = [m for m in blocks[-1].modules()
+                    if isinstance(m, torch.nn.BatchNorm2d)][-1].num_features
+    base_net = basenetworks.BaseNetwork(
+        torch.nn.Sequential(*blocks),
+        args.basenet,
+        resnet_factory.stride(blocks),
+        out_features,
+    )
+
+    head_nets = []
+    for head_name in args.headnets:
+        if head_name == 'skeleton':
+            continue
+        head = [h for h in heads.Head.__subclasses__() if h.match(head_name)][0]
+        head_nets.append(head(head_name, out_features))
+
+    return nets.Shell(base_net, head_nets)
+
+
+class DistillationLoss(torch.nn.Module):
+    """Student head fields against the soft fields of the teacher head.
+
+    Returns one loss per component like the CompositeLoss of the head, so
+    the usual --lambdas apply: a BCE of the student confidence logits
+    against the teacher confidences, and L1 losses for the regressions
+    (including their spreads) and scales weighted by the teacher
+    confidence.
+    """
+
+    def __init__(self, n_vectors, n_scales):
+        super(DistillationLoss, self).__init__()
+        self.n_vectors = n_vectors
+        self.n_scales = n_scales
+
+    @staticmethod
+    def weighted_l1(x, t, weight):
+        while weight.dim() < x.dim():
+            weight = weight.unsqueeze(2)
+        return torch.sum(torch.abs(x - t) * weight) / torch.clamp(torch.sum(weight), min=1.0)
+
+    def forward(self, x, t):  # pylint: disable=arguments-differ
+        assert len(x) == len(t) == 1 + 2 * self.n_vectors + self.n_scales
+        t_confidence = torch.sigmoid(t[0])
+        ce_loss = torch.nn.functional.binary_cross_entropy_with_logits(x[0], t_confidence)
+
+        reg_losses = []
+        for i in range(self.n_vectors):
+            x_reg, t_reg = x[1 + i], t[1 + i]
+            x_spread, t_spread = x[1 + self.n_vectors + i], t[1 + self.n_vectors + i]
+            reg_losses.append(self.weighted_l1(x_reg, t_reg, t_confidence) +
+                              self.weighted_l1(x_spread, t_spread, t_confidence))
+
+        scale_losses = [
+            self.weighted_l1(x_scale, t_scale, t_confidence)
+            for x_scale, t_scale in zip(x[1 + 2 * self.n_vectors:], t[1 + 2 * self.n_vectors:])
+        ]
+
+        return [ce_loss] + reg_losses + scale_losses
+
+
+class DistillationTrainer(Trainer):
+    """Trainer that replaces the encoded targets by teacher outputs."""
+
+    def __init__(self, model, teacher, *args, **kwargs):
+        super(DistillationTrainer, self).__init__(model, *args, **kwargs)
+        self.teacher = teacher
+
+    def teacher_targets(self, data):
+        if self.device:
+            data = data.to(self.device, non_blocking=True)
+        with torch.no_grad():
+            return data, [[f.detach() for f in head] for head in self.teacher(data)]
+
+    def train_batch(self, data, targets, meta, apply_gradients=True):  # pylint: disable=method-hidden
+        data, targets = self.teacher_targets(data)
+        return super(DistillationTrainer, self).train_batch(data, targets, meta, apply_gradients)
+
+    def val_batch(self, data, targets):
+        data, targets = self.teacher_targets(data)
+        return super(DistillationTrainer, self).val_batch(data, targets)
+
+
+def default_lambdas(head_names):
+    # PR_train defaults per head
+    lambdas = []
+    for head_name in head_names:
+        if head_name.startswith('pif'):
+            lambdas += DEFAULT_LAMBDAS['pif']
+        elif head_name.startswith('paf'):
+            lambdas += DEFAULT_LAMBDAS['paf']
+        else:
+            raise Exception('no default lambdas for head {}, set --lambdas'.format(head_name))
+    return lambdas
+
+
+def load_teacher(checkpoint, device):
+    teacher, _ = nets.factory(checkpoint=checkpoint)
+    teacher.eval()
+    for head in teacher.head_nets:
+        head.apply_class_sigmoid = False
+    for p in teacher.parameters():
+        p.requires_grad = False
+    return teacher.to(device=device)
+
+
+def default_output_file(args):
+    now = datetime.datetime.now().strftime('%y%m%d-%H%M%S')
+    return 'outputs/distill-{}-{}-edge{}-{}.pkl'.format(
+        args.basenet, '-'.join(args.headnets), args.square_edge, now)
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    logs.cli(parser)
+    nets.cli(parser)
+    encoder.cli(parser)
+    optimize.cli(parser)
+    PR_benchmark.cli(parser)
+
+    parser.add_argument('--teacher', required=True,
+                        help='checkpoint of the trained teacher')
+    parser.add_argument('-o', '--output', default=None,
+                        help='output file')
+    parser.add_argument('--epochs', default=30, type=int,
+                        help='number of epochs to train')
+    parser.add_argument('--stride-apply', default=1, type=int,
+                        help='apply and reset gradients every n batches')
+    parser.add_argument('--lambdas', default=None, type=float, nargs='+',
+                        help=('prefactor for the distillation losses of each head '
+                              '(default: the PR_train defaults of the teacher heads)'))
+    parser.add_argument('--ema', default=1e-3, type=float,
+                        help='ema decay constant')
+    parser.add_argument('--no-report', dest='report', default=True, action='store_false',
+                        help='skip the accuracy versus CPU latency report')
+    args = parser.parse_args()
+    datasets.train_configure(args)
+
+    if args.basenet is None:
+        raise Exception('choose a student with --basenet, e.g. resnet18')
+    # the report needs the centers of the frozen validation set
+    args.resample_val = False
+    PR_benchmark.configure(args)
+
+    return args
+
+
+def main():
+    args = cli()
+    logs.configure(args)
+
+    teacher = load_teacher(args.teacher, args.device)
+    # the student mirrors the heads of the teacher
+    args.headnets = [head.shortname for head in teacher.head_nets]
+    if args.output is None:
+        args.output = default_output_file(args)
+    student_cpu = student_factory(args)
+    if student_cpu.io_scales() != teacher.io_scales():
+        raise Exception('student strides {} do not match teacher strides {}'.format(
+            student_cpu.io_scales(), teacher.io_scales()))
+    for head in student_cpu.head_nets:
+        head.apply_class_sigmoid = False
+    student = student_cpu.to(device=args.device)
+
+    loss_list = [DistillationLoss(head.determine_nvectors(head.shortname),
+                                  head.determine_nscales(head.shortname))
+                 for head in teacher.head_nets]
+    if args.lambdas is None:
+        args.lambdas = default_lambdas(args.headnets)
+    n_losses = sum(1 + loss.n_vectors + loss.n_scales for loss in loss_list)
+    if len(args.lambdas) != n_losses:
+        raise Exception('need {} lambdas for the heads {}, got {}'.format(
+            n_losses, args.headnets, len(args.lambdas)))
+    optimizer, lr_scheduler = optimize.factory(args, student.parameters())
+
+    # the same synthetic composites as PR_train
+    target_transforms = encoder.factory(args, student_cpu.io_scales())
+    train_loader, val_loader, _ = datasets.train_factory(
+        args, PR_train.preprocess_factory(args, args.square_edge), target_transforms)
+
+    trainer = DistillationTrainer(
+        student, teacher, loss_list, optimizer, args.output, args.lambdas,
+        lr_scheduler=lr_scheduler,
+        device=args.device,
+        fix_batch_norm=False,
+        stride_apply=args.stride_apply,
+        ema_decay=args.ema,
+        model_meta_data={
+            'args': vars(args),
+            'version': VERSION,
+            'hostname': socket.gethostname(),
+            'teacher': args.teacher,
+        },
+    )
+    trainer.loop(train_loader, val_loader, args.epochs)
+
+    if args.report:
+        # the checkpoint of the last epoch, the trainer does not write args.output itself
+        student_file = epoch_file(args.output, args.epochs)
+        logging.getLogger(__name__).info('comparing %s to teacher %s', student_file, args.teacher)
+        models = [
+            (args.teacher, PR_benchmark.load_model(args.teacher)),
+            (student_file, PR_benchmark.load_model(student_file)),
+        ]
+        PR_benchmark.print_report(PR_benchmark.compare(models, val_loader, args))
+
+
+if __name__ == '__main__':
+    main()
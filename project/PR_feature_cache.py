@@ -0,0 +1,119 @@
+#########################################################################
+#                                                                       #
+#    Author Yannick Paul Klose                                          #
+#    Year   2019                                                        #
+#                                                                       #
+#########################################################################
+
+import json
+import os
+
+import numpy as np
+import torch
+
+from openpifpaf.datasets import collate_images_targets_meta
+
+import PR_datasets_detection
+
+
+class HeadNets(torch.nn.Module):
+    """The head networks of a Shell applied to precomputed base features."""
+
+    def __init__(self, head_nets):
+        super(HeadNets, self).__init__()
+        self.head_nets = head_nets
+
+    def forward(self, x):  # pylint: disable=arguments-differ
+        return [hn(x) for hn in self.head_nets]
+
+
+class FeatureCache(torch.utils.data.Dataset):
+    """Base net features and targets of a fixed set of composites.
+
+    The features (float16) and every target component are stored as .npy
+    files in `cache_dir` and memory-mapped, so training the heads on them
+    skips rendering, encoding and the base net forward pass.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            header = json.load(f)
+        self.metas = header['metas']
+
+        self.features = np.load(os.path.join(cache_dir, 'features.npy'), mmap_mode='r')
+        self.targets = [
+            [np.load(os.path.join(cache_dir, 'target-{}-{}.npy'.format(i, j)), mmap_mode='r')
+             for j in range(n_components)]
+            for i, n_components in enumerate(header['target_components'])
+        ]
+
+    @staticmethod
+    def build(base_net, data_loader, cache_dir, device=None):
+        # one pass of the (frozen) base net over data_loader
+        os.makedirs(cache_dir, exist_ok=True)
+        base_net.eval()
+
+        # items of repeated loaders hold several composites
+        n = len(data_loader.dataset) * PR_datasets_detection.composites_per_item(data_loader.dataset)
+        features = None
+        targets = None
+        metas = []
+        i = 0
+        with torch.no_grad():
+            for data, batch_targets, batch_meta in data_loader:
+                if device:
+                    data = data.to(device, non_blocking=True)
+                batch_features = base_net(data)
+                if isinstance(batch_features, (list, tuple)):
+                    raise Exception('feature caching needs a base net with a single output')
+                batch_features = batch_features.half().cpu().numpy()
+
+                if features is None:
+                    features = np.lib.format.open_memmap(
+                        os.path.join(cache_dir, 'features.npy'), mode='w+',
+                        dtype=np.float16, shape=(n,) + batch_features.shape[1:])
+                    targets = [
+                        [np.lib.format.open_memmap(
+                            os.path.join(cache_dir, 'target-{}-{}.npy'.format(h, c)), mode='w+',
+                            dtype=np.float32, shape=(n,) + tuple(t.shape[1:]))
+                         for c, t in enumerate(head)]
+                        for h, head in enumerate(batch_targets)
+                    ]
+
+                b = batch_features.shape[0]
+                if i + b > n:
+                    raise Exception('data loader yields more than {} composites'.format(n))
+                features[i:i + b] = batch_features
+                for head, batch_head in zip(targets, batch_targets):
+                    for t, batch_t in zip(head, batch_head):
+                        t[i:i + b] = batch_t.numpy()
+                metas += PR_datasets_detection.jsonify(batch_meta)
+                i += b
+
+        features.flush()
+        for head in targets:
+            for t in head:
+                t.flush()
+        with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+            json.dump({
+                'metas': metas,
+                'target_components': [len(head) for head in targets],
+            }, f)
+        print('cached base net features of {} images: {}'.format(n, cache_dir))
+
+        return FeatureCache(cache_dir)
+
+    def __getitem__(self, index):
+        features = torch.from_numpy(np.array(self.features[index], dtype=np.float32))
+        targets = [[torch.from_numpy(np.array(t[index])) for t in head]
+                   for head in self.targets]
+        return features, targets, self.metas[index]
+
+    def __len__(self):
+        return len(self.metas)
+
+    def loader(self, batch_size, **kwargs):
+        return torch.utils.data.DataLoader(
+            self, batch_size=batch_size, shuffle=True, drop_last=True,
+            collate_fn=collate_images_targets_meta, **kwargs)
@@ -0,0 +1,252 @@
+#########################################################################
+#                                                                       #
+#    Author Yannick Paul Klose                                          #
+#    Year   2019                                                        #
+#                                                                       #
+#########################################################################
+
+import numpy as np
+import torch
+
+
+class MotionGate(object):
+    """Skip the network for frames that barely differ from the last inferred one.
+
+    Frames are compared on a small grayscale thumbnail (mean absolute
+    difference in [0, 1]) against the last frame that went through the
+    network. Below `threshold` the previous detection is reused, or
+    linearly extrapolated from the last two inferred detections, and every
+    `max_skip` skipped frames a full inference is forced.
+
+    With `audit_interval`, every n-th skipped frame also runs the network
+    (see audit_due and audit) without changing the state of the gate. The
+    reused detections are compared to it: a target is lost when no reused
+    detection is within `lost_distance` pixels, otherwise its distance
+    counts as drift.
+    """
+
+    def __init__(self, threshold, *, max_skip=10, size=32, extrapolate=True,
+                 audit_interval=0, lost_distance=10.0):
+        self.threshold = threshold
+        self.max_skip = max_skip
+        self.size = size
+        self.extrapolate = extrapolate
+        self.audit_interval = audit_interval
+        self.lost_distance = lost_distance
+
+        self.frame = -1
+        self.thumbnail = None
+        self.reference = None
+        self.skipped = 0
+        self.history = []  # last two (frame, keypoint_sets, scores) of full inferences
+
+        self.latencies = {'full': [], 'skipped': []}
+        self.n_skipped = 0
+        self.audits = {'frames': 0, 'targets': 0, 'lost': 0, 'drift_sum': 0.0}
+
+    def score(self, image):
+        # image is a (3, H, W) tensor in [0, 1]
+        gray = image.mean(dim=0, keepdim=True).unsqueeze(0)
+        self.thumbnail = torch.nn.functional.adaptive_avg_pool2d(gray, self.size)[0, 0]
+        if self.reference is None:
+            return float('inf')
+        return float(torch.mean(torch.abs(self.thumbnail - self.reference)).item())
+
+    def needs_inference(self, image):
+        self.frame += 1
+        score = self.score(image)
+        if score > self.threshold or not self.history or self.skipped >= self.max_skip:
+            self.skipped = 0
+            self.reference = self.thumbnail
+            return True
+
+        self.skipped += 1
+        self.n_skipped += 1
+        return False
+
+    def audit_due(self):
+        # call after needs_inference returned False
+        return bool(self.audit_interval) and self.n_skipped % self.audit_interval == 0
+
+    @staticmethod
+    def positions(keypoint_sets):
+        return [kps[np.argmax(kps[:, 2]), :2] for kps in keypoint_sets]
+
+    def audit(self, keypoint_sets):
+        # compare the detections of a skipped frame to a full inference
+        reused = self.positions(self.reuse()[0])
+        self.audits['frames'] += 1
+        for xy in self.positions(keypoint_sets):
+            self.audits['targets'] += 1
+            distance = min((np.linalg.norm(xy - r) for r in reused), default=float('inf'))
+            if distance > self.lost_distance:
+                self.audits['lost'] += 1
+            else:
+                self.audits['drift_sum'] += float(distance)
+
+    def update(self, keypoint_sets, scores):
+        self.history = (self.history + [(self.frame, keypoint_sets, scores)])[-2:]
+
+    def reuse(self):
+        frame2, keypoint_sets2, scores2 = self.history[-1]
+        keypoint_sets = np.copy(keypoint_sets2)
+        if self.extrapolate and len(self.history) == 2:
+            frame1, keypoint_sets1, _ = self.history[0]
+            if keypoint_sets1.shape == keypoint_sets2.shape and len(keypoint_sets2):
+                velocity = (keypoint_sets2[:, :, :2] - keypoint_sets1[:, :, :2]) / (frame2 - frame1)
+                keypoint_sets[:, :, :2] += velocity * (self.frame - frame2)
+
+        return keypoint_sets, np.copy(scores2)
+
+    def record(self, latency, skipped):
+        self.latencies['skipped' if skipped else 'full'].append(latency)
+
+    def stats(self):
+        n_full = len(self.latencies['full'])
+        n_skipped = len(self.latencies['skipped'])
+        all_latencies = self.latencies['full'] + self.latencies['skipped']
+        return {
+            'frames': n_full + n_skipped,
+            'skip_rate': round(n_skipped / max(1, n_full + n_skipped), 3),
+            'latency_ms': round(1000.0 * float(np.mean(all_latencies)), 2) if all_latencies else None,
+            'full_latency_ms': (round(1000.0 * float(np.mean(self.latencies['full'])), 2)
+                                if n_full else None),
+            'skipped_latency_ms': (round(1000.0 * float(np.mean(self.latencies['skipped'])), 2)
+                                   if n_skipped else None),
+            'audited_frames': self.audits['frames'],
+            'lost_rate': (round(self.audits['lost'] / self.audits['targets'], 3)
+                          if self.audits['targets'] else None),
+            'drift_px': (round(self.audits['drift_sum'] / (self.audits['targets'] - self.audits['lost']), 2)
+                         if self.audits['targets'] > self.audits['lost'] else None),
+        }
+
+
+class CoarseToFine(object):
+    """Two-stage inference for small patterns.
+
+    The network first runs on the whole frame downscaled by `coarse_scale`.
+    The `top_k` strongest pif peaks above `peak_threshold` (local maxima of
+    the confidence over all fields within `nms_size`) are candidates and
+    the network runs a second time at full resolution on `crop_size` crops
+    around them. Detections in the crops are shifted back to frame
+    coordinates and duplicates from overlapping crops are merged.
+    """
+
+    def __init__(self, processor, *, coarse_scale=0.5, top_k=3, crop_size=193,
+                 peak_threshold=0.1, nms_size=3, merge_distance=8.0):
+        self.processor = processor
+        self.model = processor.model
+        self.coarse_scale = coarse_scale
+        self.top_k = top_k
+        self.crop_size = crop_size
+        self.peak_threshold = peak_threshold
+        self.nms_size = nms_size
+        self.merge_distance = merge_distance
+
+        self.n_frames = 0
+        self.n_crops = 0
+
+    def coarse_peaks(self, image_batch):
+        # candidate (x, y) in frame pixels for every image of the batch
+        coarse = torch.nn.functional.interpolate(
+            image_batch, scale_factor=self.coarse_scale, mode='bilinear', align_corners=False)
+        with torch.no_grad():
+            pif = self.model(coarse)[0]
+        confidences, fields = pif[0].max(dim=1)
+        if not self.model.head_nets[0].apply_class_sigmoid:
+            confidences = torch.sigmoid(confidences)
+
+        local_max = torch.nn.functional.max_pool2d(
+            confidences.unsqueeze(1), self.nms_size, stride=1, padding=self.nms_size // 2)[:, 0]
+        peaks = confidences * (confidences == local_max).float()
+        width = peaks.shape[2]
+        scores, indices = peaks.reshape(peaks.shape[0], -1).topk(min(self.top_k, peaks[0].numel()))
+
+        stride = self.model.io_scales()[0] / self.coarse_scale
+        candidates = []
+        for b, (image_scores, image_indices) in enumerate(zip(scores.tolist(), indices.tolist())):
+            image_candidates = []
+            for score, index in zip(image_scores, image_indices):
+                if score < self.peak_threshold:
+                    break
+                iy, ix = index // width, index % width
+                dx, dy = pif[1][b, fields[b, iy, ix], :, iy, ix].tolist()
+                image_candidates.append(((ix + dx) * stride, (iy + dy) * stride))
+            candidates.append(image_candidates)
+        return candidates
+
+    def crop_windows(self, candidates, width, height):
+        # one (x0, y0) per window, candidates already well inside a window
+        # do not get their own
+        size_x, size_y = min(self.crop_size, width), min(self.crop_size, height)
+        margin = self.crop_size / 4.0
+        windows = []
+        for x, y in candidates:
+            if any(x0 + margin <= x < x0 + size_x - margin and
+                   y0 + margin <= y < y0 + size_y - margin
+                   for x0, y0 in windows):
+                continue
+            x0 = int(np.clip(round(x - size_x / 2.0), 0, width - size_x))
+            y0 = int(np.clip(round(y - size_y / 2.0), 0, height - size_y))
+            windows.append((x0, y0))
+        return windows, size_x, size_y
+
+    def fields(self, image_batch):
+        """Per image of the batch a list of ((x0, y0), fields) of its crops."""
+        height, width = image_batch.shape[2:]
+        crops = []
+        offsets = []
+        for i, candidates in enumerate(self.coarse_peaks(image_batch)):
+            windows, size_x, size_y = self.crop_windows(candidates, width, height)
+            for x0, y0 in windows:
+                crops.append(image_batch[i, :, y0:y0 + size_y, x0:x0 + size_x])
+                offsets.append((i, (x0, y0)))
+
+        self.n_frames += image_batch.shape[0]
+        self.n_crops += len(crops)
+
+        crop_fields = [[] for _ in range(image_batch.shape[0])]
+        if crops:
+            for (i, offset), fields in zip(offsets, self.processor.fields(torch.stack(crops))):
+                crop_fields[i].append((offset, fields))
+        return crop_fields
+
+    def keypoint_sets(self, crop_fields):
+        keypoint_sets = []
+        scores = []
+        for (x0, y0), fields in crop_fields:
+            crop_keypoint_sets, crop_scores = self.processor.keypoint_sets(fields)
+            if not len(crop_keypoint_sets):
+                continue
+            visible = crop_keypoint_sets[:, :, 2] > 0.0
+            crop_keypoint_sets[:, :, 0] += x0 * visible
+            crop_keypoint_sets[:, :, 1] += y0 * visible
+            keypoint_sets += list(crop_keypoint_sets)
+            scores += list(crop_scores)
+
+        return self.merge(keypoint_sets, scores)
+
+    def merge(self, keypoint_sets, scores):
+        # greedy by score, a detection is a duplicate when its most
+        # confident keypoint is close to the one of a kept detection
+        if not keypoint_sets:
+            return self.processor.keypoint_sets_from_annotations([])
+
+        kept = []
+        kept_xy = []
+        for i in np.argsort(scores)[::-1]:
+            kps = keypoint_sets[i]
+            xy = kps[np.argmax(kps[:, 2]), :2]
+            if any(np.linalg.norm(xy - other) < self.merge_distance for other in kept_xy):
+                continue
+            kept.append(i)
+            kept_xy.append(xy)
+
+        return (np.array([keypoint_sets[i] for i in kept]),
+                np.array([scores[i] for i in kept]))
+
+    def stats(self):
+        return {
+            'frames': self.n_frames,
+            'crops_per_frame': round(self.n_crops / max(1, self.n_frames), 2),
+        }
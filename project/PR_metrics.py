@@ -0,0 +1,85 @@
+#########################################################################
+#                                                                       #
+#    Author Yannick Paul Klose                                          #
+#    Year   2019                                                        #
+#                                                                       #
+#########################################################################
+
+import torch
+
+
+PIXEL_THRESHOLDS = (5.0, 10.0, 20.0)
+DETECTION_THRESHOLD = 0.5
+
+
+def center_predictions(pif_output, stride, logits=True):
+    # strongest pif peak per image over all fields, refined with the
+    # regression at the peak and scaled to input pixels
+    confidences = pif_output[0]
+    if logits:
+        confidences = torch.sigmoid(confidences)
+    batch_size, n_fields, height, width = confidences.shape
+
+    peaks, indices = confidences.reshape(batch_size, -1).max(dim=1)
+    fields = indices // (height * width)
+    iy = (indices % (height * width)) // width
+    ix = indices % width
+
+    batch = torch.arange(batch_size, device=confidences.device)
+    offsets = pif_output[1][batch, fields, :, iy, ix]
+    xy = (torch.stack((ix, iy), dim=1).float() + offsets) * stride
+
+    return xy, peaks
+
+
+def center_statistics(pif_output, centers, stride, *,
+                      pixel_thresholds=PIXEL_THRESHOLDS,
+                      detection_threshold=DETECTION_THRESHOLD,
+                      logits=True):
+    """Accumulable counts for a batch.
+
+    centers is a (batch, 3) tensor of ground truth x, y, v in input pixels
+    with v = 0 for images without a pasted pattern.
+    """
+    xy, peaks = center_predictions(pif_output, stride, logits=logits)
+    centers = centers.to(xy.device)
+
+    positive = centers[:, 2] > 0
+    detected = peaks > detection_threshold
+    errors = torch.norm(xy - centers[:, :2], dim=1)
+    found = positive & detected
+
+    return {
+        'n_positive': int(positive.sum().item()),
+        'n_negative': int((~positive).sum().item()),
+        'n_detected': int(found.sum().item()),
+        'n_false_positive': int((detected & ~positive).sum().item()),
+        'error_sum': float(errors[found].sum().item()),
+        'hits': [int((found & (errors <= t)).sum().item()) for t in pixel_thresholds],
+    }
+
+
+def accumulate(total, stats):
+    if total is None:
+        return dict(stats, hits=list(stats['hits']))
+
+    for k, v in stats.items():
+        if k == 'hits':
+            total[k] = [a + b for a, b in zip(total[k], v)]
+        else:
+            total[k] += v
+    return total
+
+
+def summarize(total, pixel_thresholds=PIXEL_THRESHOLDS):
+    summary = {
+        'center_error': round(total['error_sum'] / max(1, total['n_detected']), 2),
+        'fp_rate': round(total['n_false_positive'] / max(1, total['n_negative']), 4),
+    }
+    for t, hits in zip(pixel_thresholds, total['hits']):
+        summary['detection_rate@{:g}'.format(t)] = round(hits / max(1, total['n_positive']), 4)
+    return summary
+
+
+def centers_from_meta(meta):
+    return torch.tensor([m['center'] for m in meta], dtype=torch.float32)
@@ -6,6 +6,7 @@
 #########################################################################
 
 from PIL import Image, ImageDraw, ImageEnhance, ImageFilter
+import functools
 import random
 import PR_image_generator
 
@@ -14,6 +15,16 @@ def overlay(background_path, object_path, paste, after_training):
     # this functions paste a given object on a background 
     # random scaling, rotation, position, noise and brightness
     
+    background = load_background(background_path, after_training)
+    (center_x, center_y, rand_x, rand_y, x1, y1), = paste_objects(background, object_path, paste)
+
+    return background, center_x, center_y, rand_x, rand_y, x1, y1
+
+
+def load_background(background_path, after_training):
+    
+    # decode the background (or a random image of the extended data set)
+    
     if after_training:
         rand_select = random.randint(0, 3)
         # select background image from Coco in 33 percent of the time!
@@ -25,9 +36,59 @@ def overlay(background_path, object_path, paste, after_training):
             background = PR_image_generator.image_generator(datapath_buffer)
     else:    
         background = Image.open(background_path).convert("RGBA")        
-    foreground = Image.open(object_path).convert("RGBA")
+    return background
+
+
+@functools.lru_cache(maxsize=4)
+def load_object(object_path):
+    # the pattern is decoded once per process, use copies of it
+    return Image.open(object_path).convert("RGBA")
+
+
+def paste_objects(background, object_path, paste, n_objects=1, max_tries=20):
+    
+    # paste up to n_objects non-overlapping, independently augmented objects
+    # on the background (in place), returns one
+    # (center_x, center_y, x_pos, y_pos, length, height) per pasted object
+    # or a single entry with zero center if paste is false
+    
+    occupied = []
+    results = []
+    for _ in range(n_objects):
+        foreground = random_object(object_path)
+        x1, y1 = foreground.size
+        for _ in range(max_tries):
+            rand_x, rand_y = random_position(background, foreground)
+            box = (rand_x, rand_y, x1, y1)
+            if not any(overlaps(box, other) for other in occupied):
+                break
+        else:
+            # no free position found
+            continue
+
+        if (paste):
+            # pase foreground image on background image
+            background.paste(foreground, (rand_x, rand_y), foreground)
+            center_x = int(rand_x+x1/2)
+            center_y = int(rand_y+y1/2)
+        else:
+            center_x = 0
+            center_y = 0
+        occupied.append(box)
+        results.append((center_x, center_y, rand_x, rand_y, x1, y1))
+
+        if not paste:
+            break
+
+    return results
+
+
+def random_object(object_path):
+    
+    # random scaling, rotation, blur and brightness of the object
+    
+    foreground = load_object(object_path).copy()
     x1, y1 = foreground.size
-    x2, y2 = background.size
 
 
     # random scaling
@@ -39,11 +100,6 @@ def overlay(background_path, object_path, paste, after_training):
     # random rotate factor
     rotate_angle = random.randint(-45, 45)
     foreground = foreground.rotate(rotate_angle, expand = True)
-    x1, y1 = foreground.size
-
-    # set random position
-    rand_x = random.randint(0, abs(x2-x1))
-    rand_y = random.randint(0, abs(y2-y1))
     
     # set random blur
     minimum_blur = 0.0
@@ -57,16 +113,21 @@ def overlay(background_path, object_path, paste, after_training):
     random_brightness = random.randint(minimum_brightness*100, maximum_brightness*100)/100
     foreground = ImageEnhance.Brightness(foreground).enhance(random_brightness)
 
-    if (paste):
-        # pase foreground image on background image
-        background.paste(foreground, (rand_x, rand_y), foreground)
-        center_x = int(rand_x+x1/2)
-        center_y = int(rand_y+y1/2)
-    else:
-        center_x = 0
-        center_y = 0
+    return foreground
 
 
-    return background, center_x, center_y, rand_x, rand_y, x1, y1
+def random_position(background, foreground):
+    x1, y1 = foreground.size
+    x2, y2 = background.size
+
+    # set random position
+    rand_x = random.randint(0, abs(x2-x1))
+    rand_y = random.randint(0, abs(y2-y1))
+    return rand_x, rand_y
 
 
+def overlaps(box, other):
+    x, y, w, h = box
+    x_other, y_other, w_other, h_other = other
+    return x < x_other + w_other and x_other < x + w and \
+        y < y_other + h_other and y_other < y + h
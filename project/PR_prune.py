@@ -0,0 +1,293 @@
+#########################################################################
+#                                                                       #
+#    Author Yannick Paul Klose                                          #
+#    Year   2019                                                        #
+#                                                                       #
+#########################################################################
+
+"""Prune channels of a trained checkpoint for CPU deployment."""
+
+import argparse
+import copy
+import logging
+import socket
+
+import torch
+import torchvision
+
+import PR_benchmark
+import PR_datasets_detection as datasets
+import PR_train
+from PR_trainer import Trainer, final_file
+from openpifpaf import encoder, logs, optimize
+from openpifpaf.network import losses, nets
+from openpifpaf import __version__ as VERSION
+
+BLOCKS = (torchvision.models.resnet.BasicBlock, torchvision.models.resnet.Bottleneck)
+
+
+def residual_blocks(model):
+    # (name, block) of every residual block of the base net
+    if isinstance(model.base_net.net, torch.nn.ModuleList):
+        raise Exception('pruning needs a base net with a single output')
+    return [(name, m) for name, m in model.named_modules()
+            if name.startswith('base_net.') and isinstance(m, BLOCKS)]
+
+
+def last_stage(model):
+    # the blocks of the stage that produces the base net output, they all
+    # share its channels through the residual connections
+    blocks = residual_blocks(model)
+    stage_name = blocks[-1][0].rpartition('.')[0]
+    stage = [(name, block) for name, block in blocks if name.rpartition('.')[0] == stage_name]
+    if stage[0][1].downsample is None:
+        raise Exception('the first block of the last stage needs a downsample to prune its output')
+    return stage
+
+
+def internal_layers(block):
+    # (conv, bn) names of the channels inside a block, followed by the name
+    # of the conv that reads them
+    if isinstance(block, torchvision.models.resnet.Bottleneck):
+        return [('conv1', 'bn1', 'conv2'), ('conv2', 'bn2', 'conv3')]
+    return [('conv1', 'bn1', 'conv2')]
+
+
+def output_layers(block):
+    if isinstance(block, torchvision.models.resnet.Bottleneck):
+        return 'conv3', 'bn3'
+    return 'conv2', 'bn2'
+
+
+def head_convs(model):
+    # names of the head convolutions that read the base net output
+    return ['head_nets.{}.{}'.format(i, name)
+            for i, head in enumerate(model.head_nets)
+            for name, m in head.named_modules()
+            if isinstance(m, torch.nn.Conv2d) and m.in_channels == model.base_net.out_features]
+
+
+def channel_importance(model, loader, device, n_batches=None):
+    """Importance of every prunable channel on the images of `loader`.
+
+    Internal channels of the residual blocks are ranked by their mean
+    activation after batch norm and ReLU. The output channels of the base
+    net are ranked by their mean activation times the L1 norm of the head
+    weights that read them. Returns a dict from batch norm names (and
+    'base_net') to per-channel importances.
+    """
+    model = model.to(device).eval()
+    modules = dict(model.named_modules())
+    names = ['{}.{}'.format(block_name, bn)
+             for block_name, block in residual_blocks(model)
+             for _, bn, _ in internal_layers(block)] + ['base_net']
+
+    sums = {}
+
+    def hook_factory(name):
+        def hook(_module, _input, output):
+            activation = output.detach().clamp(min=0.0).mean(dim=(0, 2, 3))
+            sums[name] = sums.get(name, 0.0) + activation
+        return hook
+
+    hooks = [modules[name].register_forward_hook(hook_factory(name)) for name in names]
+    n = 0
+    try:
+        with torch.no_grad():
+            for i, (images, _, _) in enumerate(loader):
+                if n_batches is not None and i >= n_batches:
+                    break
+                model(images.to(device, non_blocking=True))
+                n += 1
+    finally:
+        for hook in hooks:
+            hook.remove()
+
+    importance = {name: (s / n).cpu() for name, s in sums.items()}
+    head_weights = sum(modules[name].weight.detach().abs().sum(dim=(0, 2, 3)).cpu()
+                       for name in head_convs(model))
+    importance['base_net'] = importance['base_net'] * head_weights
+    return importance
+
+
+def keep_indices(importance, ratio, multiple=8):
+    # most important channels, a multiple of `multiple` of them
+    n = len(importance)
+    n_keep = int(round(n * (1.0 - ratio)))
+    n_keep = min(n, max(multiple, multiple * ((n_keep + multiple - 1) // multiple)))
+    return torch.sort(torch.argsort(importance, descending=True)[:n_keep])[0]
+
+
+def pruned_conv(conv, in_keep=None, out_keep=None):
+    if conv.groups != 1:
+        raise Exception('cannot prune grouped convolutions')
+    weight = conv.weight.detach()
+    bias = conv.bias.detach() if conv.bias is not None else None
+    if out_keep is not None:
+        weight = weight[out_keep]
+        bias = bias[out_keep] if bias is not None else None
+    if in_keep is not None:
+        weight = weight[:, in_keep]
+
+    pruned = torch.nn.Conv2d(weight.shape[1], weight.shape[0], conv.kernel_size,
+                             stride=conv.stride, padding=conv.padding,
+                             dilation=conv.dilation, bias=bias is not None)
+    pruned.weight.data.copy_(weight)
+    if bias is not None:
+        pruned.bias.data.copy_(bias)
+    return pruned
+
+
+def pruned_bn(bn, keep):
+    pruned = torch.nn.BatchNorm2d(len(keep), eps=bn.eps, momentum=bn.momentum,
+                                  affine=bn.affine, track_running_stats=bn.track_running_stats)
+    if bn.affine:
+        pruned.weight.data.copy_(bn.weight.detach()[keep])
+        pruned.bias.data.copy_(bn.bias.detach()[keep])
+    if bn.track_running_stats:
+        pruned.running_mean.copy_(bn.running_mean[keep])
+        pruned.running_var.copy_(bn.running_var[keep])
+        pruned.num_batches_tracked.copy_(bn.num_batches_tracked)
+    return pruned
+
+
+def replace(model, name, module):
+    parent_name, _, child_name = name.rpartition('.')
+    setattr(dict(model.named_modules())[parent_name], child_name, module)
+
+
+def prune(model, importance, ratio, multiple=8):
+    """Remove the least important channels of model (a CPU Shell) in place.
+
+    Prunes the channels inside every residual block and the output
+    channels of the last stage. The last stage output is pruned jointly in
+    all of its blocks (output convs, the downsample of the first block and
+    the inputs of the following blocks) and in the head inputs.
+    """
+    modules = dict(model.named_modules())
+
+    for block_name, block in residual_blocks(model):
+        for conv, bn, next_conv in internal_layers(block):
+            keep = keep_indices(importance['{}.{}'.format(block_name, bn)], ratio, multiple)
+            setattr(block, conv, pruned_conv(getattr(block, conv), out_keep=keep))
+            setattr(block, bn, pruned_bn(getattr(block, bn), keep))
+            setattr(block, next_conv, pruned_conv(getattr(block, next_conv), in_keep=keep))
+
+    keep = keep_indices(importance['base_net'], ratio, multiple)
+    for name in head_convs(model):
+        replace(model, name, pruned_conv(modules[name], in_keep=keep))
+    for i, (_, block) in enumerate(last_stage(model)):
+        conv, bn = output_layers(block)
+        setattr(block, conv, pruned_conv(getattr(block, conv), out_keep=keep))
+        setattr(block, bn, pruned_bn(getattr(block, bn), keep))
+        if i == 0:
+            setattr(block.downsample, '0', pruned_conv(block.downsample[0], out_keep=keep))
+            setattr(block.downsample, '1', pruned_bn(block.downsample[1], keep))
+        else:
+            block.conv1 = pruned_conv(block.conv1, in_keep=keep)
+    model.base_net.out_features = len(keep)
+
+    return model
+
+
+def default_output_file(checkpoint, ratio):
+    base = checkpoint[:-4] if checkpoint.endswith('.pkl') else checkpoint
+    return '{}.prune{:02d}.pkl'.format(base, int(round(ratio * 100)))
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    logs.cli(parser)
+    nets.cli(parser)
+    losses.cli(parser)
+    encoder.cli(parser)
+    optimize.cli(parser)
+    PR_benchmark.cli(parser)
+
+    parser.add_argument('--ratios', default=[0.25, 0.5, 0.75], type=float, nargs='+',
+                        help='fractions of channels to remove, one checkpoint per ratio')
+    parser.add_argument('--channel-multiple', default=8, type=int,
+                        help='keep a multiple of this number of channels per layer')
+    parser.add_argument('--rank-batches', default=None, type=int,
+                        help='number of validation batches to rank the channels on')
+    parser.add_argument('--epochs', default=3, type=int,
+                        help='number of fine-tuning epochs per ratio')
+    parser.add_argument('--stride-apply', default=1, type=int,
+                        help='apply and reset gradients every n batches')
+    parser.add_argument('--lambdas', default=[30.0, 2.0, 2.0, 50.0, 3.0, 3.0],
+                        type=float, nargs='+',
+                        help='prefactor for head losses')
+    parser.add_argument('--ema', default=1e-3, type=float,
+                        help='ema decay constant')
+    args = parser.parse_args()
+    datasets.train_configure(args)
+
+    if args.checkpoint is None:
+        raise Exception('choose the checkpoint to prune with --checkpoint')
+
+    # the report needs the centers of the frozen validation set
+    args.resample_val = False
+    PR_benchmark.configure(args)
+
+    return args
+
+
+def main():
+    args = cli()
+    logs.configure(args)
+    log = logging.getLogger(__name__)
+
+    net_cpu, _ = nets.factory_from_args(args)
+    args.headnets = [head.shortname for head in net_cpu.head_nets]
+    target_transforms = encoder.factory(args, net_cpu.io_scales())
+    train_loader, val_loader, _ = datasets.train_factory(
+        args, PR_train.preprocess_factory(args, args.square_edge), target_transforms)
+
+    importance = channel_importance(net_cpu, val_loader, args.device, args.rank_batches)
+    net_cpu.cpu()
+
+    outputs = []
+    for ratio in args.ratios:
+        pruned_cpu = prune(copy.deepcopy(net_cpu), importance, ratio, args.channel_multiple)
+        for head in pruned_cpu.head_nets:
+            head.apply_class_sigmoid = False
+        pruned = pruned_cpu.to(device=args.device)
+
+        output = default_output_file(args.checkpoint, ratio)
+        log.info('pruned %.0f%% of the channels: %d parameters, writing %s',
+                 ratio * 100.0, PR_benchmark.n_parameters(pruned), output)
+
+        optimizer, lr_scheduler = optimize.factory(args, pruned.parameters())
+        trainer = Trainer(
+            pruned, losses.factory_from_args(args), optimizer, output, args.lambdas,
+            lr_scheduler=lr_scheduler,
+            device=args.device,
+            fix_batch_norm=True,
+            stride_apply=args.stride_apply,
+            ema_decay=args.ema,
+            val_stride=pruned_cpu.io_scales()[0],
+            pixel_thresholds=args.val_pixel_thresholds,
+            detection_threshold=args.val_detection_threshold,
+            model_meta_data={
+                'args': vars(args),
+                'version': VERSION,
+                'hostname': socket.gethostname(),
+                'pruned_from': args.checkpoint,
+                'prune_ratio': ratio,
+            },
+        )
+        if args.epochs:
+            trainer.loop(train_loader, val_loader, args.epochs)
+        else:
+            trainer.write_model(0, final=True)
+        outputs.append(final_file(output))
+
+    models = [(name, PR_benchmark.load_model(name)) for name in [args.checkpoint] + outputs]
+    PR_benchmark.print_report(PR_benchmark.compare(models, val_loader, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+#########################################################################
+#                                                                       #
+#    Author Yannick Paul Klose                                          #
+#    Year   2019                                                        #
+#                                                                       #
+#########################################################################
+
+import collections
+import contextlib
+import http.server
+import os
+import threading
+import time
+
+import torch
+
+
+class Histogram(object):
+    """HDR-style histogram of latencies in microseconds.
+
+    Every power of two is split into 2**sub_bucket_bits linear buckets, so
+    quantiles have a relative error below 2**-sub_bucket_bits over any range
+    of values with a small, bounded number of buckets.
+    """
+
+    def __init__(self, sub_bucket_bits=5):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts = collections.Counter()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def bucket(self, value):
+        # (lower bound, width) of the bucket holding value
+        shift = max(0, value.bit_length() - 1 - self.sub_bucket_bits)
+        return (value >> shift) << shift, 1 << shift
+
+    def record(self, seconds):
+        value = max(0, int(round(seconds * 1e6)))
+        self.counts[self.bucket(value)[0]] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        # highest value equivalent to the bucket of the q-quantile in seconds
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for lower in sorted(self.counts):
+            seen += self.counts[lower]
+            if seen >= rank:
+                _, width = self.bucket(lower)
+                return min(lower + width - 1, self.max) / 1e6
+        return self.max / 1e6
+
+    def mean(self):
+        return self.total / self.count / 1e6 if self.count else None
+
+
+class Telemetry(object):
+    """Per-stage latency histograms and throughput.
+
+    Stages are timed with `with telemetry.stage(name):`. On CUDA devices the
+    device is synchronized at the end of a stage so that asynchronous
+    kernels are attributed to the stage that launched them. A disabled
+    Telemetry times nothing.
+    """
+
+    quantiles = (0.5, 0.95, 0.99)
+
+    def __init__(self, device=None, enabled=True):
+        self.enabled = enabled
+        self.synchronize = device is not None and device.type == 'cuda'
+        self.histograms = collections.OrderedDict()
+        self.n_images = 0
+        self.start_time = time.perf_counter()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        yield
+        if self.synchronize:
+            torch.cuda.synchronize()
+        self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].record(seconds)
+
+    def count_images(self, n=1):
+        with self.lock:
+            self.n_images += n
+
+    def throughput(self):
+        return self.n_images / max(1e-9, time.perf_counter() - self.start_time)
+
+    def summary(self):
+        with self.lock:
+            stages = collections.OrderedDict(
+                (name, {
+                    'count': h.count,
+                    'mean_ms': round(h.mean() * 1000.0, 3),
+                    'p50_ms': round(h.quantile(0.5) * 1000.0, 3),
+                    'p95_ms': round(h.quantile(0.95) * 1000.0, 3),
+                    'p99_ms': round(h.quantile(0.99) * 1000.0, 3),
+                    'max_ms': round(h.max / 1000.0, 3),
+                })
+                for name, h in self.histograms.items()
+            )
+        return {
+            'images': self.n_images,
+            'throughput': round(self.throughput(), 2),
+            'stages': stages,
+        }
+
+    def report(self):
+        summary = self.summary()
+        print('{:>16s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s}'.format(
+            'stage', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+        for name, s in summary['stages'].items():
+            print('{:>16s} {:>8d} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+                name, s['count'], s['p50_ms'], s['p95_ms'], s['p99_ms'], s['max_ms']))
+        print('{} images, {:.2f} images/s'.format(summary['images'], summary['throughput']))
+
+    def prometheus(self):
+        lines = [
+            '# HELP pifpaf_stage_latency_seconds Latency of inference stages.',
+            '# TYPE pifpaf_stage_latency_seconds summary',
+        ]
+        with self.lock:
+            for name, h in self.histograms.items():
+                for q in self.quantiles:
+                    lines.append('pifpaf_stage_latency_seconds{{stage="{}",quantile="{}"}} {:.6f}'.format(
+                        name, q, h.quantile(q)))
+                lines.append('pifpaf_stage_latency_seconds_sum{{stage="{}"}} {:.6f}'.format(
+                    name, h.total / 1e6))
+                lines.append('pifpaf_stage_latency_seconds_count{{stage="{}"}} {}'.format(
+                    name, h.count))
+        lines += [
+            '# HELP pifpaf_images_total Number of processed images.',
+            '# TYPE pifpaf_images_total counter',
+            'pifpaf_images_total {}'.format(self.n_images),
+            '# HELP pifpaf_throughput_images_per_second Images per second since start.',
+            '# TYPE pifpaf_throughput_images_per_second gauge',
+            'pifpaf_throughput_images_per_second {:.3f}'.format(self.throughput()),
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        # atomic for the node exporter textfile collector
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+    def serve(self, port, host='127.0.0.1'):
+        telemetry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):  # pylint: disable=invalid-name
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = telemetry.prometheus().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        server = http.server.HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
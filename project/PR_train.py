@@ -13,8 +13,11 @@ import socket
 import torch
 
 import PR_datasets_detection as datasets
+import PR_feature_cache
+import PR_metrics
+from PR_trainer import Trainer
 from openpifpaf import encoder, logs, optimize, transforms
-from openpifpaf.network import losses, nets, Trainer
+from openpifpaf.network import losses, nets
 from openpifpaf import __version__ as VERSION
 
 
@@ -37,6 +40,61 @@ def default_output_file(args):
     return out
 
 
+def preprocess_factory(args, square_edge):
+    return transforms.SquareMix(
+        transforms.SquareCrop(square_edge, random_hflip=True, horizontal_swap=None),
+        transforms.SquareRescale(square_edge, black_bars=True, random_hflip=True,horizontal_swap=None),
+        crop_fraction=args.crop_fraction,
+    )
+
+
+def resolution_schedule(args, net_cpu, train_loader):
+    # (first epoch, square edge, train loader factory) for every step of
+    # the progressive schedule, the last step trains at --square-edge
+    steps = []
+    first_epoch = 0
+    for square_edge, n_epochs in zip(args.progressive_edges, args.progressive_epochs):
+        steps.append((first_epoch, square_edge))
+        first_epoch += n_epochs
+    steps.append((first_epoch, args.square_edge))
+
+    def loader_factory(square_edge):
+        batch_size = args.batch_size
+        if args.progressive_batch_scaling:
+            batch_size = max(1, int(args.batch_size * (args.square_edge / square_edge) ** 2))
+
+        def factory():
+            print('training at square edge {} with batch size {}'.format(square_edge, batch_size))
+            return datasets.rescale_loader(
+                train_loader,
+                preprocess_factory(args, square_edge),
+                encoder.factory(args, net_cpu.io_scales()),
+                batch_size,
+            )
+        return factory
+
+    return [(first_epoch, square_edge, loader_factory(square_edge))
+            for first_epoch, square_edge in steps]
+
+
+def report_schedule(stage_times):
+    # compare every step to the average epoch time at the final resolution
+    _, final_times = stage_times[-1]
+    if not final_times:
+        return
+    final_epoch_time = sum(final_times) / len(final_times)
+
+    saved = 0.0
+    for square_edge, times in stage_times:
+        if not times:
+            continue
+        epoch_time = sum(times) / len(times)
+        saved += (final_epoch_time - epoch_time) * len(times)
+        print('square edge {}: {} epochs, {:.1f}s per epoch ({:.0%} of final)'.format(
+            square_edge, len(times), epoch_time, epoch_time / final_epoch_time))
+    print('progressive schedule saved {:.1f}s of training time'.format(saved))
+
+
 def cli():
     parser = argparse.ArgumentParser(
         description=__doc__,
@@ -59,11 +117,25 @@ def cli():
                         help='number of epochs to train with frozen base')
     parser.add_argument('--pre-lr', type=float, default=1e-4,
                         help='pre learning rate')
+    parser.add_argument('--cache-frozen-features', default=False, action='store_true',
+                        help=('during --freeze-base epochs, train the heads on base net '
+                              'features of a fixed pretraining set that are computed once'))
+    parser.add_argument('--pre-feature-cache', default=None,
+                        help='directory for the cached features (default: output + .prefeatures)')
+    parser.add_argument('--pre-seed', default=0, type=int,
+                        help='seed for rendering the cached pretraining set')
     parser.add_argument('--update-batchnorm-runningstatistics',
                         default=False, action='store_true',
                         help='update batch norm running statistics')
     parser.add_argument('--square-edge', default=401, type=int,
                         help='square edge of input images')
+    parser.add_argument('--progressive-edges', default=[], type=int, nargs='+',
+                        help='square edges for the first steps of a progressive '
+                             'resolution schedule, the last step uses --square-edge')
+    parser.add_argument('--progressive-epochs', default=[], type=int, nargs='+',
+                        help='number of epochs for each of the progressive edges')
+    parser.add_argument('--progressive-batch-scaling', default=False, action='store_true',
+                        help='scale the batch size inversely with the number of pixels')
     parser.add_argument('--crop-fraction', default=0.5, type=float,
                         help='crop fraction versus rescale')
     parser.add_argument('--lambdas', default=[30.0, 2.0, 2.0, 50.0, 3.0, 3.0],
@@ -71,6 +143,17 @@ def cli():
                         help='prefactor for head losses')
     parser.add_argument('--ema', default=1e-3, type=float,
                         help='ema decay constant')
+    parser.add_argument('--val-pixel-thresholds', default=list(PR_metrics.PIXEL_THRESHOLDS),
+                        type=float, nargs='+',
+                        help='pixel thresholds for the validation detection rates')
+    parser.add_argument('--val-detection-threshold', default=PR_metrics.DETECTION_THRESHOLD,
+                        type=float, help='confidence threshold for a validation detection')
+    parser.add_argument('--async-checkpoint', default=False, action='store_true',
+                        help='write checkpoints from a CPU snapshot in a background thread')
+    parser.add_argument('--keep-checkpoints', default=None, type=int,
+                        help='keep only the last n epoch checkpoints')
+    parser.add_argument('--weights-sidecar', default=False, action='store_true',
+                        help='also write a weights-only .weights file per checkpoint')
     parser.add_argument('--debug-without-plots', default=False, action='store_true',
                         help='enable debug but dont plot')
     parser.add_argument('--profile', default=None,
@@ -78,6 +161,7 @@ def cli():
     parser.add_argument('--disable-cuda', action='store_true',
                         help='disable CUDA')
     args = parser.parse_args()
+    datasets.train_configure(args)
 
     if args.output is None:
         args.output = default_output_file(args)
@@ -85,6 +169,12 @@ def cli():
     if args.debug and 'skeleton' not in args.headnets:
         raise Exception('add "skeleton" as last headnet to see debug output')
 
+    if len(args.progressive_edges) != len(args.progressive_epochs):
+        raise Exception('need one number of epochs for every progressive edge')
+    if args.progressive_edges and sum(args.progressive_epochs) >= args.epochs:
+        raise Exception('progressive epochs ({}) leave no epochs of --epochs {} for the final edge'.format(
+            sum(args.progressive_epochs), args.epochs))
+
     if args.debug_without_plots:
         args.debug = True
 
@@ -115,11 +205,7 @@ def main():
     loss_list = losses.factory_from_args(args)
     target_transforms = encoder.factory(args, net_cpu.io_scales())
 
-    preprocess = transforms.SquareMix(
-        transforms.SquareCrop(args.square_edge, random_hflip=True, horizontal_swap=None),
-        transforms.SquareRescale(args.square_edge, black_bars=True, random_hflip=True,horizontal_swap=None),
-        crop_fraction=args.crop_fraction,
-    )
+    preprocess = preprocess_factory(args, args.square_edge)
     train_loader, val_loader, pre_train_loader = datasets.train_factory(
         args, preprocess, target_transforms)
 
@@ -148,9 +234,20 @@ def main():
         foptimizer = torch.optim.SGD(
             (p for p in net.parameters() if p.requires_grad),
             lr=args.pre_lr, momentum=0.9, weight_decay=0.0, nesterov=True)
-        ftrainer = Trainer(net, loss_list, foptimizer, args.output, args.lambdas,
-                           device=args.device, fix_batch_norm=True,
-                           encoder_visualizer=encoder_visualizer)
+        if args.cache_frozen_features:
+            # base net forward once, heads train from the cached features
+            cache = PR_feature_cache.FeatureCache.build(
+                net_cpu.base_net, datasets.seeded_loader(pre_train_loader, args.pre_seed),
+                args.pre_feature_cache or args.output + '.prefeatures', device=args.device)
+            pre_train_loader = cache.loader(args.batch_size, pin_memory=args.pin_memory,
+                                            num_workers=args.loader_workers)
+            ftrainer = Trainer(PR_feature_cache.HeadNets(net_cpu.head_nets), loss_list, foptimizer,
+                               args.output, args.lambdas,
+                               device=args.device, fix_batch_norm=True)
+        else:
+            ftrainer = Trainer(net, loss_list, foptimizer, args.output, args.lambdas,
+                               device=args.device, fix_batch_norm=True,
+                               encoder_visualizer=encoder_visualizer)
         for i in range(-args.freeze_base, 0):
             ftrainer.train(pre_train_loader, i)
 
@@ -168,13 +265,29 @@ def main():
         ema_decay=args.ema,
         encoder_visualizer=encoder_visualizer,
         train_profile=args.profile,
+        val_stride=None if args.resample_val else net_cpu.io_scales()[0],
+        pixel_thresholds=args.val_pixel_thresholds,
+        detection_threshold=args.val_detection_threshold,
+        sample_loss_observer=(train_loader.sampler.update
+                              if isinstance(train_loader.sampler, datasets.HardExampleSampler)
+                              else None),
+        async_checkpoint=args.async_checkpoint,
+        keep_checkpoints=args.keep_checkpoints,
+        weights_sidecar=args.weights_sidecar,
         model_meta_data={
             'args': vars(args),
             'version': VERSION,
             'hostname': socket.gethostname(),
         },
     )
-    trainer.loop(train_loader, val_loader, args.epochs, start_epoch=start_epoch)
+    if args.progressive_edges:
+        stage_times = trainer.loop_schedule(
+            resolution_schedule(args, net_cpu, train_loader),
+            val_loader, args.epochs, start_epoch=start_epoch)
+        report_schedule(stage_times)
+    else:
+        trainer.loop(train_loader, val_loader, args.epochs, start_epoch=start_epoch)
+    trainer.flush_checkpoints()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,296 @@
+#########################################################################
+#                                                                       #
+#    Author Yannick Paul Klose                                          #
+#    Year   2019                                                        #
+#                                                                       #
+#########################################################################
+
+import argparse
+import concurrent.futures
+import copy
+import glob
+import os
+import re
+import shutil
+import time
+
+import torch
+
+from openpifpaf.network import nets, trainer
+
+import PR_metrics
+
+
+class Trainer(trainer.Trainer):
+    """openpifpaf Trainer with task metrics on the validation set.
+
+    With `val_stride` set, every validation epoch also reports the center
+    error, the detection rates at pixel thresholds and the false positive
+    rate on no-paste images (see PR_metrics) from the same forward pass
+    that computes the validation losses.
+
+    With `sample_loss_observer` set, the confidence loss of every training
+    sample is passed on as observer(dataset_indices, losses) after each
+    batch (e.g. to HardExampleSampler.update).
+
+    Like upstream, every epoch is written to `<out>.epochNNN` and the last
+    one is copied to `<out>.final.pkl` (see final_file). Checkpoints are
+    written atomically (temporary file and rename). With
+    `async_checkpoint`, a CPU snapshot of the model is written by a
+    background thread while training continues; call flush_checkpoints()
+    before exiting. `keep_checkpoints` keeps only the last n epoch
+    checkpoints and `weights_sidecar` also writes a `.weights` file with
+    only the state dict (see load_weights).
+    """
+
+    def __init__(self, model, losses, optimizer, out, lambdas, *,
+                 val_stride=None,
+                 pixel_thresholds=PR_metrics.PIXEL_THRESHOLDS,
+                 detection_threshold=PR_metrics.DETECTION_THRESHOLD,
+                 sample_loss_observer=None,
+                 async_checkpoint=False,
+                 keep_checkpoints=None,
+                 weights_sidecar=False,
+                 **kwargs):
+        super(Trainer, self).__init__(model, losses, optimizer, out, lambdas, **kwargs)
+
+        self.val_stride = val_stride
+        self.pixel_thresholds = pixel_thresholds
+        self.detection_threshold = detection_threshold
+        self.sample_loss_observer = sample_loss_observer
+
+        self.keep_checkpoints = keep_checkpoints
+        self.weights_sidecar = weights_sidecar
+        self.checkpoint_executor = None
+        if async_checkpoint:
+            self.checkpoint_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pending_checkpoint = None
+
+    def loop_schedule(self, schedule, val_scenes, epochs, start_epoch=0):
+        """Like loop() with a different train loader for each stage.
+
+        schedule is a list of (first_epoch, name, train_scenes_factory)
+        sorted by first_epoch. A stage lasts until the next stage starts and
+        its factory is only called when the stage is trained. Returns a list
+        of (name, train epoch times) per stage.
+        """
+        for _ in range(start_epoch):
+            if self.lr_scheduler is not None:
+                self.lr_scheduler.step()
+
+        stage_times = []
+        for i, (first_epoch, name, train_scenes_factory) in enumerate(schedule):
+            end_epoch = min(schedule[i + 1][0] if i + 1 < len(schedule) else epochs, epochs)
+            if end_epoch <= start_epoch:
+                continue
+
+            train_scenes = train_scenes_factory()
+            times = []
+            for epoch in range(max(first_epoch, start_epoch), end_epoch):
+                epoch_start = time.time()
+                self.train(train_scenes, epoch)
+                times.append(time.time() - epoch_start)
+
+                self.write_model(epoch + 1, epoch == epochs - 1)
+                self.val(val_scenes, epoch + 1)
+            stage_times.append((name, times))
+
+        return stage_times
+
+    def write_model(self, epoch, final=True):
+        # at most one snapshot is pending, this also raises errors of the
+        # previous write
+        self.flush_checkpoints()
+
+        model = self.model
+        if isinstance(model, torch.nn.DataParallel):
+            model = model.module
+        snapshot = cpu_snapshot(model)
+
+        if self.checkpoint_executor is None:
+            self.save_checkpoint(snapshot, epoch, final)
+        else:
+            self.pending_checkpoint = self.checkpoint_executor.submit(
+                self.save_checkpoint, snapshot, epoch, final)
+
+    def flush_checkpoints(self):
+        if self.pending_checkpoint is not None:
+            pending, self.pending_checkpoint = self.pending_checkpoint, None
+            pending.result()
+
+    def save_checkpoint(self, model, epoch, final=False):
+        # every epoch goes to <out>.epochNNN, the final one is also copied
+        # to <out>.final.pkl
+        start_time = time.time()
+        filename = epoch_file(self.out, epoch)
+        atomic_save({
+            'model': model,
+            'epoch': epoch,
+            'meta': self.model_meta_data,
+        }, filename)
+        if self.weights_sidecar:
+            atomic_save({
+                'state_dict': model.state_dict(),
+                'epoch': epoch,
+                'meta': self.model_meta_data,
+            }, filename + '.weights')
+        if final:
+            atomic_copy(filename, final_file(self.out))
+            if self.weights_sidecar:
+                atomic_copy(filename + '.weights', final_file(self.out) + '.weights')
+        if self.keep_checkpoints is not None:
+            self.prune_checkpoints()
+
+        self.log.debug('model written to %s in %.1fs', filename, time.time() - start_time)
+
+    def prune_checkpoints(self):
+        # keep the last keep_checkpoints epoch checkpoints (and their sidecars)
+        pattern = re.compile(re.escape(self.out) + r'\.epoch(\d+)$')
+        epoch_files = sorted(
+            (int(m.group(1)), f)
+            for m, f in ((pattern.match(f), f) for f in glob.glob(glob.escape(self.out) + '.epoch*'))
+            if m is not None
+        )
+        n_remove = max(0, len(epoch_files) - self.keep_checkpoints)
+        for _, f in epoch_files[:n_remove]:
+            for old_file in (f, f + '.weights'):
+                if os.path.exists(old_file):
+                    os.remove(old_file)
+
+    def train_batch(self, data, targets, meta, apply_gradients=True):  # pylint: disable=method-hidden
+        if self.sample_loss_observer is None:
+            return super(Trainer, self).train_batch(data, targets, meta, apply_gradients)
+
+        # capture the outputs of the training forward pass
+        outputs = []
+        hook = self.model.register_forward_hook(
+            lambda _module, _input, output: outputs.append(output))
+        try:
+            result = super(Trainer, self).train_batch(data, targets, meta, apply_gradients)
+        finally:
+            hook.remove()
+
+        self.sample_loss_observer(
+            [m['dataset_index'] for m in meta],
+            self.sample_losses(outputs[0], targets),
+        )
+        return result
+
+    def sample_losses(self, outputs, targets):
+        # confidence loss (lambda weighted BCE of the first head) of every
+        # sample in one vectorized pass, the same masking and background
+        # weight as the CompositeLoss but without the batch reduction
+        x_intensity = outputs[0][0].detach()
+        target_intensity = targets[0][0]
+        if self.device:
+            target_intensity = target_intensity.to(self.device, non_blocking=True)
+
+        with torch.no_grad():
+            mask = (torch.sum(target_intensity, dim=1, keepdim=True) > 0.5).float()
+            bce_target = target_intensity[:, :-1]
+            weight = torch.ones_like(bce_target)
+            weight[bce_target == 0] = getattr(self.losses[0], 'background_weight', 1.0)
+            losses = torch.nn.functional.binary_cross_entropy_with_logits(
+                x_intensity, bce_target, weight=weight * mask, reduction='none')
+            losses = self.lambdas[0] * losses.sum(dim=(1, 2, 3))
+        return losses.tolist()
+
+    def val(self, scenes, epoch):
+        if self.val_stride is None:
+            return super(Trainer, self).val(scenes, epoch)
+
+        start_time = time.time()
+        self.model.eval()
+
+        epoch_loss = 0.0
+        head_epoch_losses = [0.0 for _ in self.lambdas]
+        statistics = None
+        for data, targets, meta in scenes:
+            if self.device:
+                data = data.to(self.device, non_blocking=True)
+                targets = [[t.to(self.device, non_blocking=True) for t in head] for head in targets]
+
+            with torch.no_grad():
+                outputs = self.model(data)
+                loss, head_losses = self.loss(outputs, targets)
+                statistics = PR_metrics.accumulate(statistics, PR_metrics.center_statistics(
+                    outputs[0], PR_metrics.centers_from_meta(meta), self.val_stride,
+                    pixel_thresholds=self.pixel_thresholds,
+                    detection_threshold=self.detection_threshold,
+                ))
+
+            if loss is not None:
+                epoch_loss += float(loss.item())
+            for i, head_loss in enumerate(head_losses):
+                if head_loss is None:
+                    continue
+                head_epoch_losses[i] += float(head_loss.item())
+        eval_time = time.time() - start_time
+
+        val_info = {
+            'type': 'val-epoch',
+            'epoch': epoch,
+            'loss': round(epoch_loss / len(scenes), 5),
+            'head_losses': [round(l / len(scenes), 5) for l in head_epoch_losses],
+            'time': round(eval_time, 1),
+        }
+        val_info.update(PR_metrics.summarize(statistics, self.pixel_thresholds))
+        self.log.info(val_info)
+
+
+def cpu_snapshot(model):
+    # deep copy with parameters and buffers copied to the CPU, the training
+    # model stays on its device
+    memo = {}
+    for p in model.parameters():
+        memo[id(p)] = torch.nn.Parameter(p.detach().cpu().clone(), requires_grad=p.requires_grad)
+    for b in model.buffers():
+        memo[id(b)] = b.detach().cpu().clone()
+    return copy.deepcopy(model, memo)
+
+
+def epoch_file(out, epoch):
+    return '{}.epoch{:03d}'.format(out, epoch)
+
+
+def final_file(out):
+    return '{}.final.pkl'.format(out)
+
+
+def atomic_save(obj, filename):
+    tmp_filename = filename + '.tmp'
+    torch.save(obj, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def atomic_copy(src, filename):
+    tmp_filename = filename + '.tmp'
+    shutil.copyfile(src, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def load_weights(weights_file):
+    """Network from a .weights sidecar written by the Trainer.
+
+    The architecture is rebuilt without pretrained weights through
+    nets.factory_from_args on the training arguments in the meta data, so
+    dilation and the other network options are the same as in training.
+    This only works for networks trained from a --basenet. Returns
+    (net_cpu, epoch) initialized for evaluation like nets.factory.
+    """
+    checkpoint = torch.load(weights_file, map_location='cpu')
+    train_args = argparse.Namespace(**copy.deepcopy(checkpoint['meta']['args']))
+    if train_args.basenet is None or train_args.checkpoint:
+        raise Exception('{} was not trained from a --basenet, load the full checkpoint'.format(
+            weights_file))
+    train_args.checkpoint = None
+    train_args.pretrained = False
+
+    net_cpu, _ = nets.factory_from_args(train_args)
+    net_cpu.load_state_dict(checkpoint['state_dict'])
+
+    net_cpu.eval()
+    for head in net_cpu.head_nets:
+        head.apply_class_sigmoid = True
+
+    return net_cpu, checkpoint['epoch']
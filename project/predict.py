@@ -9,6 +9,7 @@ import argparse
 import glob
 import json
 import os
+import time
 
 import numpy as np
 import torch
@@ -18,6 +19,9 @@ from openpifpaf import decoder, transforms
 
 import openpifpaf.datasets as datasets
 import show
+import PR_inference
+import PR_telemetry
+import PR_trainer
 from data import COCO_LABELS
 
 import torchvision
@@ -47,6 +51,42 @@ def cli():
                         help='figure width')
     parser.add_argument('--dpi-factor', default=1.0, type=float,
                         help='increase dpi of output image by this factor')
+    parser.add_argument('--motion-gate-threshold', default=None, type=float,
+                        help=('reuse the previous detection when the mean absolute '
+                              'difference of downsampled frames is below this value'))
+    parser.add_argument('--motion-gate-max-skip', default=10, type=int,
+                        help='force a full inference after this many skipped frames')
+    parser.add_argument('--motion-gate-size', default=32, type=int,
+                        help='edge of the downsampled frames that are compared')
+    parser.add_argument('--motion-gate-audit-interval', default=0, type=int,
+                        help=('also run the network on every n-th skipped frame to measure '
+                              'lost targets and drift of the reused detections'))
+    parser.add_argument('--motion-gate-lost-distance', default=10.0, type=float,
+                        help='pixel distance at which an audited target counts as lost')
+    parser.add_argument('--no-motion-gate-extrapolate', dest='motion_gate_extrapolate',
+                        default=True, action='store_false',
+                        help='reuse skipped detections without extrapolating them')
+    parser.add_argument('--coarse-to-fine', default=False, action='store_true',
+                        help=('find candidates on a downscaled frame and only run '
+                              'full resolution crops around them'))
+    parser.add_argument('--coarse-scale', default=0.5, type=float,
+                        help='scale of the frame for the coarse pass')
+    parser.add_argument('--coarse-top-k', default=3, type=int,
+                        help='maximum number of candidates from the coarse pass')
+    parser.add_argument('--coarse-peak-threshold', default=0.1, type=float,
+                        help='minimum confidence of a coarse candidate')
+    parser.add_argument('--crop-size', default=193, type=int,
+                        help='edge of the full resolution crops around candidates')
+    parser.add_argument('--telemetry', default=False, action='store_true',
+                        help='report per-stage latency percentiles and throughput')
+    parser.add_argument('--telemetry-prometheus', default=None,
+                        help='write telemetry in Prometheus text format to this file')
+    parser.add_argument('--telemetry-port', default=None, type=int,
+                        help='serve telemetry in Prometheus text format on this port')
+    parser.add_argument('--telemetry-host', default='127.0.0.1',
+                        help='address the telemetry port binds to (0.0.0.0 for all interfaces)')
+    parser.add_argument('--telemetry-interval', default=100, type=int,
+                        help='update the Prometheus file every n images')
     args = parser.parse_args()
 
     # glob
@@ -55,6 +95,10 @@ def cli():
     if not args.images:
         raise Exception("no image files given")
 
+    # any telemetry output enables telemetry
+    if args.telemetry_prometheus or args.telemetry_port:
+        args.telemetry = True
+
     # add args.device
     args.device = torch.device('cpu')
     args.pin_memory = False
@@ -68,7 +112,11 @@ def main():
     args = cli()
 
     # load model
-    model, _ = nets.factory_from_args(args)
+    if args.checkpoint and args.checkpoint.endswith('.weights'):
+        # weights-only sidecar of PR_train --weights-sidecar
+        model, _ = PR_trainer.load_weights(args.checkpoint)
+    else:
+        model, _ = nets.factory_from_args(args)
     model = model.to(args.device)
     processor = decoder.factory_from_args(args, model)
 
@@ -82,11 +130,49 @@ def main():
     skeleton_painter = show.InstancePainter(show_box=False, color_connections=True,
                                             markersize=1, linewidth=6)
 
+    # motion gate (frames are processed one at a time)
+    gate = None
+    if args.motion_gate_threshold is not None:
+        gate = PR_inference.MotionGate(args.motion_gate_threshold,
+                                       max_skip=args.motion_gate_max_skip,
+                                       size=args.motion_gate_size,
+                                       extrapolate=args.motion_gate_extrapolate,
+                                       audit_interval=args.motion_gate_audit_interval,
+                                       lost_distance=args.motion_gate_lost_distance)
+
+    # two-stage inference
+    coarse_to_fine = None
+    if args.coarse_to_fine:
+        coarse_to_fine = PR_inference.CoarseToFine(processor,
+                                                   coarse_scale=args.coarse_scale,
+                                                   top_k=args.coarse_top_k,
+                                                   crop_size=args.crop_size,
+                                                   peak_threshold=args.coarse_peak_threshold)
+
+    # telemetry
+    telemetry = PR_telemetry.Telemetry(args.device, enabled=args.telemetry)
+    if args.telemetry_port:
+        telemetry.serve(args.telemetry_port, args.telemetry_host)
+
+    last_batch_end = time.perf_counter()
     for image_i, (image_paths, image_tensors, processed_images_cpu) in enumerate(data_loader):
+        telemetry.record('load', time.perf_counter() - last_batch_end)
         images = image_tensors.permute(0, 2, 3, 1)
-
-        processed_images = processed_images_cpu.to(args.device, non_blocking=True)
-        fields_batch = processor.fields(processed_images)
+        start = time.time()
+
+        with telemetry.stage('motion_gate'):
+            skip = gate is not None and not gate.needs_inference(image_tensors[0])
+            audit = skip and gate.audit_due()
+        if skip and not audit:
+            fields_batch = [None]
+        else:
+            with telemetry.stage('transfer'):
+                processed_images = processed_images_cpu.to(args.device, non_blocking=True)
+            with telemetry.stage('fields'):
+                if coarse_to_fine is not None:
+                    fields_batch = coarse_to_fine.fields(processed_images)
+                else:
+                    fields_batch = processor.fields(processed_images)
         # unbatch
         for image_path, image, processed_image_cpu, fields in zip(
                 image_paths,
@@ -101,11 +187,24 @@ def main():
                 output_path = os.path.join(args.output_directory, file_name)
             print('image', image_i, image_path, output_path)
 
-            processor.set_cpu_image(image, processed_image_cpu)
-            keypoint_sets, scores = processor.keypoint_sets(fields)
+            with telemetry.stage('keypoint_sets'):
+                if fields is None:
+                    keypoint_sets, scores = gate.reuse()
+                else:
+                    processor.set_cpu_image(image, processed_image_cpu)
+                    if coarse_to_fine is not None:
+                        keypoint_sets, scores = coarse_to_fine.keypoint_sets(fields)
+                    else:
+                        keypoint_sets, scores = processor.keypoint_sets(fields)
+                    if audit:
+                        gate.audit(keypoint_sets)
+                    elif gate is not None:
+                        gate.update(keypoint_sets, scores)
+            if gate is not None:
+                gate.record(time.time() - start, skipped=fields is None)
 
             if 'json' in args.output_types:
-                with open(output_path + '.pifpaf.json', 'w') as f:
+                with telemetry.stage('json'), open(output_path + '.pifpaf.json', 'w') as f:
                     json.dump([
                         {'keypoints': np.around(kps, 1).reshape(-1).tolist(),
                          'bbox': [np.min(kps[:, 0]), np.min(kps[:, 1]),
@@ -116,13 +215,28 @@ def main():
             texts = [COCO_LABELS[np.argmax(kps[:,2])+1] for kps in keypoint_sets]
 
             if 'skeleton' in args.output_types:
-                with show.image_canvas(image,
-                                       output_path + '.skeleton.png',
-                                       show=args.show,
-                                       fig_width=args.figure_width,
-                                       dpi_factor=args.dpi_factor) as ax:
+                with telemetry.stage('render'), show.image_canvas(image,
+                                                                  output_path + '.skeleton.png',
+                                                                  show=args.show,
+                                                                  fig_width=args.figure_width,
+                                                                  dpi_factor=args.dpi_factor) as ax:
                     skeleton_painter.keypoints(ax, keypoint_sets, scores=scores,texts=texts)
 
+            telemetry.count_images()
+
+        if args.telemetry_prometheus and (image_i + 1) % args.telemetry_interval == 0:
+            telemetry.write_prometheus(args.telemetry_prometheus)
+        last_batch_end = time.perf_counter()
+
+    if gate is not None:
+        print('motion gate', gate.stats())
+    if coarse_to_fine is not None:
+        print('coarse to fine', coarse_to_fine.stats())
+    if args.telemetry:
+        telemetry.report()
+    if args.telemetry_prometheus:
+        telemetry.write_prometheus(args.telemetry_prometheus)
+
 
 if __name__ == '__main__':
     main()